@@ -0,0 +1,236 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from conductor_creation import create_tip_masks, create_tip_levels, create_tip_grid
+from potential_simulation import V_0
+
+# Adaptive quadtree meshes for tip spaces #
+#
+# The tip space square is split into n0 x n0 root cells, and cells are
+# split into four down to max_level where they are cut by a tip surface
+# near the gap or lie in the gap itself; elsewhere surfaces are only
+# resolved to surface_level and the far field is left coarse. The mesh is
+# kept 2:1 balanced so a cell never touches a cell more than one level
+# finer. A mesh is a dict of per-leaf arrays: level, integer position
+# (i, j) at that level, centre and width. The square is the extent of
+# create_tip_grid, so the mesh covers the same space as the grid model.
+
+_x, _y = create_tip_grid(2, 2)
+if not np.allclose((_x[0], _x[-1]), (_y[0], _y[-1])):
+    raise ValueError("adaptive meshes need a square tip space")
+ORIGIN = _x[0]
+SIZE = _x[-1] - _x[0]
+
+def _keys(level, i, j):
+    # one sortable integer per (level, i, j) #
+    return (level.astype(np.int64) << 56) | (i.astype(np.int64) << 28) | j.astype(np.int64)
+
+def _children(level, i, j):
+    # the four children of each cell, as flat arrays #
+    level = np.repeat(level + 1, 4)
+    i = 2*np.repeat(i, 4) + np.tile([0, 0, 1, 1], len(i))
+    j = 2*np.repeat(j, 4) + np.tile([0, 1, 0, 1], len(j))
+    return level, i, j
+
+def _cell_geometry(level, i, j, n0):
+    h = SIZE / (n0 * 2.0**level)
+    centre = np.column_stack((ORIGIN + (i + 0.5)*h, ORIGIN + (j + 0.5)*h))
+    return centre, h
+
+def _tip_edges(d0, theta1, theta2, x_offset):
+    # apex and the unit directions of the two edges of each tip #
+    tip1 = ((x_offset, -d0/2), [(-np.sin(theta1), -np.cos(theta1)),
+                                (np.sin(theta2), -np.cos(theta2))])
+    tip2 = ((0.0, d0/2), [(-np.sin(theta2), np.cos(theta2)),
+                          (np.sin(theta1), np.cos(theta1))])
+    return tip1, tip2
+
+def _edge_distance(points, edges):
+    # distance from points (n,2) to the nearer of a tip's two edges #
+    apex = np.asarray(edges[0])
+    distance = np.inf
+    for direction in edges[1]:
+        direction = np.asarray(direction)
+        t = np.maximum(0.0, (points - apex).dot(direction))
+        distance = np.minimum(distance, np.sqrt(((points - apex - t[:, np.newaxis]*direction)**2).sum(axis=1)))
+    return distance
+
+def _target_level(level, i, j, n0, levels, edges, max_level, surface_level, gap):
+    # level each cell should be refined to, from the tip geometry #
+    centre, h = _cell_geometry(level, i, j, n0)
+    corners = [centre + 0.5*h[:, np.newaxis]*np.array(c)
+               for c in ((-1, -1), (-1, 1), (1, -1), (1, 1))]
+    target = np.zeros(len(level), dtype=int)
+    values = []; inside = []; distance = []
+    for level_func, tip in zip(levels, edges):
+        f = np.array([level_func(p[:, 0], p[:, 1]) for p in corners + [centre]])
+        values.append(f)
+        inside.append(f[-1] <= 0)
+        distance.append(np.where(f[-1] <= 0, 0.0, _edge_distance(centre, tip)))
+    for n, f in enumerate(values):
+        # cut by the surface, or holding the apex, of this tip #
+        cut = (f.min(axis=0) <= 0) & (f.max(axis=0) > 0)
+        ax, ay = edges[n][0]
+        cut |= (np.abs(centre[:, 0] - ax) <= 0.5*h) & (np.abs(centre[:, 1] - ay) <= 0.5*h)
+        near = distance[1 - n] <= gap + h
+        target = np.maximum(target, np.where(cut & near, max_level, np.where(cut, surface_level, 0)))
+    # empty cells between the tips where they are closer than gap #
+    in_gap = ~inside[0] & ~inside[1] & (distance[0] + distance[1] <= gap + 2*h)
+    target = np.maximum(target, np.where(in_gap, max_level, 0))
+    return target
+
+def _balance(level, i, j):
+    # split leaves until no leaf touches a leaf two or more levels finer #
+    while True:
+        # every internal node (ancestor of a leaf) at every level #
+        internal = []
+        for l in np.unique(level):
+            for up in range(1, l + 1):
+                sel = level == l
+                internal.append(_keys(np.full(sel.sum(), l - up), i[sel] >> up, j[sel] >> up))
+        internal = np.unique(np.concatenate(internal)) if internal else np.zeros(0, np.int64)
+        split = np.zeros(len(level), dtype=bool)
+        for di, dj in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            # a same-level neighbour with an internal child holds level+2 leaves #
+            cl, ci, cj = _children(level, i + di, j + dj)
+            has = np.isin(_keys(cl, ci, cj), internal).reshape(-1, 4).any(axis=1)
+            split |= has
+        if not split.any():
+            return level, i, j
+        cl, ci, cj = _children(level[split], i[split], j[split])
+        level = np.concatenate((level[~split], cl))
+        i = np.concatenate((i[~split], ci)); j = np.concatenate((j[~split], cj))
+
+def build_tip_mesh(d0, theta1, theta2, x_offset, n0=16, max_level=7,
+                   surface_level=None, gap=None):
+    '''
+    Quadtree mesh over the tip space refined for the given tips. Cells cut
+    by a tip surface within `gap` (default 1.5 times the closest tip to tip
+    distance) of the other tip, and empty cells whose distances to the two
+    tips add up to less than `gap`, are
+    refined to max_level; other surface cells go to surface_level
+    (default max_level // 2). With n0=16 and max_level=7 the finest cells
+    are about 5 nm across.
+    '''
+    levels = create_tip_levels(d0, theta1, theta2, x_offset)
+    edges = _tip_edges(d0, theta1, theta2, x_offset)
+    if surface_level is None:
+        surface_level = max_level // 2
+    if gap is None:
+        # the closest approach of two wedges is from one of the apexes #
+        separation = min(_edge_distance(np.array([edges[0][0]]), edges[1])[0],
+                         _edge_distance(np.array([edges[1][0]]), edges[0])[0])
+        gap = 1.5 * separation
+    i, j = [a.ravel() for a in np.meshgrid(np.arange(n0), np.arange(n0), indexing='ij')]
+    level = np.zeros(len(i), dtype=int)
+    leaves = []
+    for l in range(max_level + 1):
+        target = _target_level(level, i, j, n0, levels, edges, max_level, surface_level, gap)
+        split = target > l
+        leaves.append((level[~split], i[~split], j[~split]))
+        level, i, j = _children(level[split], i[split], j[split])
+    level, i, j = [np.concatenate(a) for a in zip(*leaves)]
+    level, i, j = _balance(level, i, j)
+    order = np.argsort(_keys(level, i, j))
+    level = level[order]; i = i[order]; j = j[order]
+    centre, h = _cell_geometry(level, i, j, n0)
+    return {'n0': n0, 'level': level, 'i': i, 'j': j, 'keys': _keys(level, i, j),
+            'centre': centre, 'h': h}
+
+def _lookup(mesh, level, i, j):
+    # index of the leaf with this (level, i, j), or -1 #
+    keys = _keys(level, i, j)
+    index = np.searchsorted(mesh['keys'], keys)
+    index = np.minimum(index, len(mesh['keys']) - 1)
+    found = mesh['keys'][index] == keys
+    return np.where(found, index, -1)
+
+def mesh_faces(mesh):
+    '''
+    Faces between neighbouring leaves as (a, b, width, distance) arrays,
+    and a mask of the leaves that touch the edge of the tip space. Faces
+    between different levels are listed from the finer leaf.
+    '''
+    level = mesh['level']; i = mesh['i']; j = mesh['j']; h = mesh['h']
+    n = mesh['n0'] * 2**level
+    edge = (i == 0) | (j == 0) | (i == n - 1) | (j == n - 1)
+    faces = []
+    cells = np.arange(len(level))
+    for di, dj in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+        ni = i + di; nj = j + dj
+        inside = (ni >= 0) & (nj >= 0) & (ni < n) & (nj < n)
+        same = np.where(inside, _lookup(mesh, level, ni, nj), -1)
+        if di + dj > 0:
+            # same level faces are listed once, from the lower cell #
+            sel = same >= 0
+            faces.append((cells[sel], same[sel], h[sel], h[sel]))
+        coarse = np.where(inside & (same < 0) & (level > 0),
+                          _lookup(mesh, level - 1, ni >> 1, nj >> 1), -1)
+        sel = coarse >= 0
+        faces.append((cells[sel], coarse[sel], h[sel], 0.5*(h[sel] + h[coarse[sel]])))
+    a, b, width, distance = [np.concatenate(f) for f in zip(*faces)]
+    return a, b, width, distance, edge
+
+def rasterize_mesh(mask_func, mesh):
+    # evaluate a vectorised object mask at every leaf centre #
+    return mask_func(mesh['centre'][:, 0], mesh['centre'][:, 1])
+
+def mesh_surface(mesh, mask, q):
+    '''
+    Surface leaves of an object: leaves inside it sharing a face with an
+    empty leaf. Returns the compact (leaf index, charge) form.
+    '''
+    a, b, width, distance, edge = mesh_faces(mesh)
+    surface = np.zeros(len(mask), dtype=bool)
+    surface[a[mask[a] & ~mask[b]]] = True
+    surface[b[mask[b] & ~mask[a]]] = True
+    index = np.flatnonzero(surface).astype(np.int32)
+    return index, np.full(len(index), q, dtype=np.int8)
+
+def create_tip_mesh_space(d0, theta1, theta2, x_offset, **kwargs):
+    '''
+    Adaptive mesh version of create_tip_space. Returns the mesh, the int8
+    space of each leaf (1 in tip 1, -1 in tip 2) and the compact surfaces,
+    whose indices refer to mesh leaves. Keyword arguments go to
+    build_tip_mesh.
+    '''
+    mesh = build_tip_mesh(d0, theta1, theta2, x_offset, **kwargs)
+    tip1_mask, tip2_mask = create_tip_masks(d0, theta1, theta2, x_offset)
+    t1 = rasterize_mesh(tip1_mask, mesh)
+    t2 = rasterize_mesh(tip2_mask, mesh)
+    space = t1.astype(np.int8) - t2.astype(np.int8)
+    surfaces = [mesh_surface(mesh, t1, 1), mesh_surface(mesh, t2, -1)]
+    return mesh, space, surfaces
+
+def calculate_potential_mesh(mesh, space, V=V_0):
+    '''
+    Potential on each leaf with tip 1 at +V, tip 2 at -V and the leaves on
+    the edge of the tip space grounded, from a finite volume Laplace solve
+    (flux width/distance across each face) on the adaptive mesh.
+    '''
+    a, b, width, distance, edge = mesh_faces(mesh)
+    n = len(space)
+    c = width / distance
+    L = sparse.coo_matrix((np.concatenate((c, c, -c, -c)),
+                           (np.concatenate((a, b, a, b)), np.concatenate((b, a, a, b)))),
+                          shape=(n, n)).tocsr()
+    fixed = (space != 0) | edge
+    free = ~fixed
+    potential = V * np.sign(space).astype(np.float64)
+    potential[edge & (space == 0)] = 0.0
+    lu = splu(L[free][:, free].tocsc())
+    potential[free] = lu.solve(-L[free][:, fixed].dot(potential[fixed]))
+    return potential
+
+def locate(mesh, points):
+    # leaf index holding each (x, y) point #
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    index = np.full(len(points), -1)
+    for l in np.unique(mesh['level']):
+        h = SIZE / (mesh['n0'] * 2.0**l)
+        n = mesh['n0'] * 2**l
+        i = np.clip(((points[:, 0] - ORIGIN) / h).astype(int), 0, n - 1)
+        j = np.clip(((points[:, 1] - ORIGIN) / h).astype(int), 0, n - 1)
+        found = _lookup(mesh, np.full(len(points), l), i, j)
+        index = np.where(found >= 0, found, index)
+    return index
@@ -0,0 +1,212 @@
+import time
+import shutil
+import tempfile
+import numpy as np
+from scipy.optimize import minimize
+from process_pool import pool_map
+from alignment_map import scan_positions, scan_grid_size, check_grid_size
+from sweep_cache import DEFAULTS, run_sweep, run_sweep_3d
+
+# Fit the simulation to measured alignment data #
+#
+# The model is the simulated amplitude (and phase) of tip 1 at the scan
+# positions shifted by the alignment centre (x0, z0), for a gap d0 and tip
+# angles theta1, theta2. Measured signals are in instrument units, so for
+# each channel the scale and offset are solved by linear least squares
+# and the cost is the remaining sum of squares over the data variance.
+# Free parameters are searched in a unit box: the cost is sampled at
+# random points, then Nelder-Mead runs from the best few at once on a
+# process pool. Parameters are snapped to `resolution` of their range
+# before the model is called, and every model point goes through the
+# on-disk cache of sweep_cache, so the sample stage, all starts and all
+# scans of a session share each other's evaluations.
+#
+# Measured data is either a 2d map (fit_alignment_map) or a 1d line
+# through the alignment peak (fit_alignment_profile). Series of fitted
+# Gaussian centroids (afm_alignment_data.amplitude_params over a session)
+# are not fitted: they follow the alignment centre but carry next to
+# nothing about d0 or the tip angles, so the 1d profile is used as the
+# reduced input instead.
+
+MAP_PARAMETERS = ('d0', 'theta1', 'theta2', 'x0', 'z0')
+PROFILE_PARAMETERS = ('d0', 'theta1', 'theta2', 'x0')
+DEFAULT_BOUNDS = {'d0': (100e-9, 2e-6), 'theta1': (np.radians(5), np.radians(60)),
+                  'theta2': (np.radians(5), np.radians(60)),
+                  'x0': (-1e-6, 1e-6), 'z0': (-1e-6, 1e-6)}
+
+def _profile_model(p, settings):
+    # amplitude and phase along a 1d scan from the 2d tip space #
+    return run_sweep(settings['cache_dir'], settings['nx'], settings['ny'], processes=1,
+                     d0=p['d0'], theta1=p['theta1'], theta2=p['theta2'],
+                     V_0=settings['V'], k_0=settings['k'], x_offset=settings['x'] - p['x0'])
+
+def _map_model(p, settings):
+    # amplitude and phase maps, indexed [x, z], from the 3d tips #
+    return run_sweep_3d(settings['cache_dir'], settings['n'], settings['shape'], processes=1,
+                        d0=p['d0'], theta1=p['theta1'], theta2=p['theta2'],
+                        V_0=settings['V'], k_0=settings['k'],
+                        x_offset=settings['x'] - p['x0'], z_offset=settings['z'] - p['z0'])
+
+MODELS = {'profile': _profile_model, 'map': _map_model}
+
+def _channel_cost(model, data):
+    # residual of the best scale * model + offset, relative to the data variance #
+    model = model.ravel(); data = data.ravel()
+    A = np.column_stack((model, np.ones_like(model)))
+    coef = np.linalg.lstsq(A, data, rcond=None)[0]
+    variance = ((data - data.mean())**2).sum() or 1.0
+    return ((data - A.dot(coef))**2).sum() / variance
+
+def _unit_cost(kind, data, settings, names, fixed, bounds, resolution):
+    '''
+    Cost of a point u in the unit box of the free parameters, with the
+    parameters snapped to resolution. Returns cost(u) and a dict counting
+    cost evaluations and the model points computed and read from cache.
+    '''
+    lo = np.array([bounds[name][0] for name in names])
+    hi = np.array([bounds[name][1] for name in names])
+    counts = {'costs': 0, 'computed': 0, 'cached': 0}
+    def cost(u):
+        # out of box points are clipped and penalised by their distance #
+        clipped = np.clip(u, 0.0, 1.0)
+        penalty = ((u - clipped)**2).sum()
+        p = dict(fixed)
+        p.update(zip(names, lo + (hi - lo) * np.round(clipped / resolution) * resolution))
+        result = MODELS[kind](p, settings)
+        counts['costs'] += 1
+        counts['computed'] += result['computed']
+        counts['cached'] += result['cached']
+        model = (result['amplitude'], result['phase'])
+        return sum(_channel_cost(m, d) for m, d in zip(model, data)
+                   if d is not None) + penalty
+    return cost, counts
+
+def _sample_cost(args):
+    # cost of one sample point #
+    kind, data, settings, names, fixed, bounds, resolution, point = args
+    cost, counts = _unit_cost(kind, data, settings, names, fixed, bounds, resolution)
+    return cost(point), counts
+
+def _fit_from_start(args):
+    # one Nelder-Mead search from a start point #
+    kind, data, settings, names, fixed, bounds, resolution, start, maxiter = args
+    lo = np.array([bounds[name][0] for name in names])
+    hi = np.array([bounds[name][1] for name in names])
+    cost, counts = _unit_cost(kind, data, settings, names, fixed, bounds, resolution)
+    # a wide first simplex, as the pixelated model is flat over small steps #
+    simplex = np.vstack([start] + [start + step for step in 0.2*np.eye(len(start))])
+    simplex = np.where(simplex > 1.0, simplex - 0.4, simplex)
+    result = minimize(cost, start, method='Nelder-Mead',
+                      options={'maxiter': maxiter, 'xatol': resolution, 'fatol': 1e-6,
+                               'initial_simplex': simplex})
+    u = np.round(np.clip(result.x, 0.0, 1.0) / resolution) * resolution
+    return lo + (hi - lo) * u, cost(u), counts
+
+def multi_start_fit(kind, data, settings, names, fixed=None, bounds=None, starts=8,
+                    samples=None, seed=0, processes=None, resolution=1e-3, maxiter=200,
+                    cache_dir=None):
+    '''
+    Fit the free parameters `names` of a model in MODELS to data (a list
+    of amplitude and phase arrays, either may be None). The cost is first
+    evaluated at `samples` points (default 8 per start: the centre of the
+    bounds and random points) and Nelder-Mead is run from the best
+    `starts` of them, as the pixelated model has many local minima. Both
+    stages are spread over `processes` workers by pool_map. Model points
+    are cached in cache_dir (a temporary directory, removed afterwards,
+    if None). Returns a dict with the best parameters (fixed ones included),
+    its cost, the cost of every start, the number of cost evaluations,
+    model points computed (model_calls) and read from the cache
+    (cache_hits), and the wall time.
+    '''
+    start_time = time.time()
+    temporary = cache_dir is None
+    if temporary:
+        cache_dir = tempfile.mkdtemp(prefix='alignment_fit_')
+    settings = dict(settings, cache_dir=cache_dir)
+    fixed = dict(fixed or {})
+    bounds = dict(DEFAULT_BOUNDS, **(bounds or {}))
+    names = [name for name in names if name not in fixed]
+    if samples is None:
+        samples = 8 * starts
+    rng = np.random.RandomState(seed)
+    points = [np.full(len(names), 0.5)] + [rng.uniform(0, 1, len(names))
+                                          for n in range(max(samples, starts) - 1)]
+    common = (kind, data, settings, names, fixed, bounds, resolution)
+    try:
+        samples = pool_map(_sample_cost, [common + (point,) for point in points],
+                           processes)
+        order = np.argsort([c for c, counts in samples])[:starts]
+        results = pool_map(_fit_from_start,
+                           [common + (points[n], maxiter) for n in order], processes)
+    finally:
+        if temporary:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    counts = [c for cost, c in samples] + [r[2] for r in results]
+    best = min(range(len(results)), key=lambda n: results[n][1])
+    params = dict(fixed)
+    params.update(zip(names, results[best][0]))
+    return {'params': params, 'cost': results[best][1],
+            'start_costs': np.array([r[1] for r in results]),
+            'cost_calls': sum(c['costs'] for c in counts),
+            'model_calls': sum(c['computed'] for c in counts),
+            'cache_hits': sum(c['cached'] for c in counts),
+            'time': time.time() - start_time}
+
+def fit_alignment_profile(x, amplitude, phase=None, nx=200, ny=200, voltage=None, k=None,
+                          **kwargs):
+    '''
+    Fit d0, the tip angles and the centre x0 to a 1d alignment scan, with
+    x in nm (as in afm_alignment_data) and the measured amplitude and
+    optionally phase at each x, taken at the tip voltage `voltage` (V_0
+    by default). This stands in for a centroid series, see the module
+    notes. The simulated phase jumps as single surface points cross
+    resonance, so fits are steadier on amplitude alone. Uses the 2d tip
+    space on an nx by ny grid; keyword arguments go to multi_start_fit.
+    '''
+    settings = {'x': 1e-9*np.asarray(x, dtype=np.float64), 'nx': nx, 'ny': ny,
+                'V': DEFAULTS['V_0'] if voltage is None else voltage,
+                'k': DEFAULTS['k_0'] if k is None else k}
+    return multi_start_fit('profile', [amplitude, phase], settings,
+                           PROFILE_PARAMETERS, **kwargs)
+
+def fit_alignment_map(afm_data, n=None, shape='pyramid', use_phase=False, k=None,
+                      **kwargs):
+    '''
+    Fit d0, the tip angles and the centre (x0, z0) to a measured 2d
+    alignment scan (an afm_alignment_data or simulated_alignment_data),
+    using the 3d tips at the scan positions and voltage of the scan. n
+    is the number of cells per side of the 3d grid, by default the
+    fewest that resolve the scan step (see simulated_alignment_data).
+    The phase map is only used if use_phase is set (see
+    fit_alignment_profile). Keyword arguments go to multi_start_fit.
+    '''
+    if n is None:
+        n = scan_grid_size(afm_data.scan_step)
+    voltage = afm_data.voltage
+    settings = {'x': 1e-9*scan_positions(afm_data.scan_size, afm_data.scan_step),
+                'z': 1e-9*scan_positions(afm_data.scan_size, afm_data.scan_step),
+                'n': check_grid_size(n, afm_data.scan_step), 'shape': shape,
+                'V': DEFAULTS['V_0'] if voltage is None else voltage,
+                'k': DEFAULTS['k_0'] if k is None else k}
+    data = [afm_data.amplitude, afm_data.phase if use_phase else None]
+    return multi_start_fit('map', data, settings, MAP_PARAMETERS, **kwargs)
+
+def fit_session(scans, cache_dir=None, **kwargs):
+    '''
+    Fit every alignment scan of a session with fit_alignment_map, adding
+    the scan number to each report. All scans share one model cache,
+    cache_dir or a temporary directory removed at the end.
+    '''
+    temporary = cache_dir is None
+    if temporary:
+        cache_dir = tempfile.mkdtemp(prefix='alignment_fit_')
+    reports = []
+    try:
+        for scan in scans:
+            report = fit_alignment_map(scan, cache_dir=cache_dir, **kwargs)
+            report['scan_n'] = getattr(scan, 'scan_n', len(reports))
+            reports.append(report)
+    finally:
+        if temporary:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    return reports
@@ -0,0 +1,73 @@
+import numpy as np
+from process_pool import pool_map
+from tip_space_3d import create_tip_grid_3d, alignment_response_3d
+
+# Simulated 2d alignment scans #
+#
+# In the experiment tip 1 is rastered across tip 2 in the plane normal to
+# the tip axis, giving the alignment_scan_fr / alignment_scan_ftheta maps
+# read by afm_alignment_data. Here the same raster moves the 3d tip 1 by
+# (x_offset, z_offset), the tip axis being y in tip_space_3d. Scan sizes,
+# steps and positions are in nm, as in afm_alignment_data, and the maps
+# are indexed [x, y] like the loaded itx waves.
+
+def scan_positions(scan_size, scan_step):
+    # scan positions (nm) along one axis, as used for the measured maps #
+    return np.arange(-scan_size/2.0, scan_size/2.0, scan_step)
+
+def scan_grid_size(scan_step):
+    # cells per side of the 3d tip space for a spacing of at most scan_step (nm) #
+    x = create_tip_grid_3d(2)[0]
+    return int(np.ceil(1e9*(x[-1] - x[0]) / scan_step - 1e-9)) + 1
+
+def check_grid_size(n, scan_step):
+    # the grid has to resolve the scan step or neighbouring offsets look the same #
+    x = create_tip_grid_3d(n)[0]
+    if 1e9*(x[1] - x[0]) > scan_step * (1 + 1e-9):
+        raise ValueError("a %d cell grid (%.1f nm) does not resolve a %g nm scan step, "
+                         "use n >= %d" % (n, 1e9*(x[1] - x[0]), scan_step,
+                                          scan_grid_size(scan_step)))
+    return n
+
+def _map_row(args):
+    # amplitude and phase along one scan row #
+    x_offset, z_offsets, d0, theta1, theta2, n, shape, V, k = args
+    row = np.empty((2, len(z_offsets)))
+    for j, z_offset in enumerate(z_offsets):
+        row[:, j] = alignment_response_3d(d0, theta1, theta2, x_offset, n, shape,
+                                          z_offset, V, k)
+    return row
+
+class simulated_alignment_data:
+    def __init__(self, scan_size=1000.0, scan_step=50.0, d0=500e-9,
+                 theta1=np.radians(30), theta2=np.radians(15), n=None,
+                 shape='pyramid', voltage=None, k=None, processes=None):
+        '''
+        Simulated alignment scan with the attributes of afm_alignment_data
+        (amplitude, phase, x, y, scan_size, scan_step, voltage) so both can
+        be displayed and analysed the same way. Each scan row is one task
+        for pool_map over `processes` workers. voltage and k default to V_0
+        and k_0. n is the number of cells per side of the 3d grid: by
+        default the fewest with a spacing of at most scan_step. A coarser n
+        raises ValueError.
+        '''
+        self.scan_size = float(scan_size)
+        self.scan_step = float(scan_step)
+        n = check_grid_size(scan_grid_size(self.scan_step) if n is None else n,
+                            self.scan_step)
+        self.voltage = voltage
+        self.params = {'d0': d0, 'theta1': theta1, 'theta2': theta2, 'n': n,
+                       'shape': shape, 'k': k}
+        self.x = scan_positions(self.scan_size, self.scan_step)
+        self.y = scan_positions(self.scan_size, self.scan_step)
+        tasks = [(1e-9*x, 1e-9*self.y, d0, theta1, theta2, n, shape, voltage, k)
+                 for x in self.x]
+        maps = np.array(pool_map(_map_row, tasks, processes))
+        self.amplitude = maps[:, 0]
+        self.phase = maps[:, 1]
+
+def simulate_like(afm_data, d0=500e-9, theta1=np.radians(30), theta2=np.radians(15),
+                  **kwargs):
+    # simulated scan with the size, step and voltage of a measured scan #
+    return simulated_alignment_data(afm_data.scan_size, afm_data.scan_step, d0,
+                                    theta1, theta2, voltage=afm_data.voltage, **kwargs)
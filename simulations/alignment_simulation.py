@@ -1,8 +1,13 @@
 import sys
 import os
+import itertools
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
 from conductor_creation import *
+from frame_rendering import save_frames, render_frames
+from process_pool import pool_map
 
 # define global parameters #
 e = -1.6e-19
@@ -15,86 +20,179 @@ f_s = 13.0e3 / 2
 omega_s = 2*np.pi*f_s
 omega_p = 2 * omega_s
 
-def calculate_contribution(d_0, A_ov):
-    k_e = k_0 - ((eps_0 * A_ov * V_0**2) / (2 * d_0**3))
-    z_m1 = ((eps_0 * A_ov * V_0**2) /\
-           (4 * d_0**2 * np.sqrt((k_e - m*omega_p**2)**2 + (beta * omega_p)**2)))
-    phi_1 = (np.arctan((beta * omega_p) /\
-                       (k_e - m * omega_p**2)))
+def calculate_contribution(d_0, A_ov, V=None, k=None, omega=None):
+    # V, k and omega default to the global V_0, k_0 and omega_p #
+    V = V_0 if V is None else V
+    k = k_0 if k is None else k
+    omega = omega_p if omega is None else omega
+    k_e = k - ((eps_0 * A_ov * V**2) / (2 * d_0**3))
+    z_m1 = ((eps_0 * A_ov * V**2) /\
+           (4 * d_0**2 * np.sqrt((k_e - m*omega**2)**2 + (beta * omega)**2)))
+    phi_1 = (np.arctan((beta * omega) /\
+                       (k_e - m * omega**2)))
     return z_m1, phi_1
 
+def frequency_response(separations, A_ov, omegas, V=None, k=None):
+    '''
+    Summed amplitude and phase of many configurations at many drive
+    frequencies in one broadcast. separations is a list of separation
+    arrays (one per configuration, any lengths) or a 2d array with one
+    row per configuration; A_ov is a scalar or a matching list of areas.
+    Returns amplitude and phase arrays of shape (configurations, omegas).
+    '''
+    omegas = np.atleast_1d(np.asarray(omegas, dtype=np.float64))
+    separations = [np.ravel(d_0s) for d_0s in separations]
+    counts = [len(d_0s) for d_0s in separations]
+    config = np.repeat(np.arange(len(separations)), counts)
+    d_0s = np.concatenate(separations) if separations else np.zeros(0)
+    if np.ndim(A_ov) == 0:
+        areas = A_ov
+    else:
+        areas = np.concatenate([np.broadcast_to(a, (n,)) for a, n in zip(A_ov, counts)])
+        areas = areas[:, np.newaxis]
+    # one (point, frequency) table, then summed over the points of each configuration #
+    z_m1, phi_1 = calculate_contribution(d_0s[:, np.newaxis], areas, V, k,
+                                         omegas[np.newaxis, :])
+    amplitude = np.zeros((len(separations), len(omegas)))
+    phase = np.zeros((len(separations), len(omegas)))
+    np.add.at(amplitude, config, z_m1)
+    np.add.at(phase, config, phi_1)
+    return amplitude, phase
+
 def get_separation(surfaces, x, y):
-    d_0s = np.array([])
-    s1 = surfaces[0]
-    s2 = surfaces[1]
-    #print 'dx =', (s2[100][0] - s1[100][0]), 'dy =', (s2[100][1] - s1[100][1])
-    #print s1.shape, s2.shape
-    [s1.shape[0], s2.shape[0]]
-    for i in range(min([s1.shape[0], s2.shape[0]])):
-        x2 = x[s2[i][0]]
-        x1 = x[s1[i][0]]
-        y2 = y[s2[i][1]]
-        y1 = y[s1[i][1]]
-        d_0 = np.sqrt((x2-x1)**2 + (y2-y1)**2)
-        d_0s = np.append(d_0s, d_0)
+    # pair surface point i on tip 1 with surface point i on tip 2 #
+    s1, _ = split_surface(surfaces[0])
+    s2, _ = split_surface(surfaces[1])
+    n = min([s1.shape[0], s2.shape[0]])
+    s1 = s1[:n]; s2 = s2[:n]
+    d_0s = np.hypot(x[s2[:,0]] - x[s1[:,0]], y[s2[:,1]] - y[s1[:,1]])
+    return d_0s
+
+def get_nearest_separation(surfaces, x, y, k=1, return_index=False):
+    '''
+    Separation from every surface point on tip 1 to its nearest point(s)
+    on tip 2, found with a KD-tree built over the tip 2 surface.
+    Returns an (n,) array for k=1 or an (n,k) array sorted by distance,
+    and optionally the matching tip 2 surface indices.
+    '''
+    p1 = surface_coordinates(surfaces[0], x, y)
+    p2 = surface_coordinates(surfaces[1], x, y)
+    shape = (p1.shape[0],) if k == 1 else (p1.shape[0], k)
+    if p1.shape[0] == 0 or p2.shape[0] == 0:
+        d_0s = np.zeros(shape); index = np.zeros(shape, dtype=np.intp)
+    else:
+        tree = cKDTree(p2)
+        d_0s, index = tree.query(p1, k=k)
+    if return_index:
+        return d_0s, index
     return d_0s
 
-def main():
+def space_response(x, y, space, charge_space, surfaces, V=None, k=None):
+    # total amplitude and phase contribution from a created tip space #
+    A_ov = ((x.max()-x.min())/len(x)) * ((y.max()-y.min())/len(y))
+    d_0s = get_nearest_separation(surfaces, x, y)
+    z_m1, phi_1 = calculate_contribution(d_0s, A_ov, V, k)
+    return z_m1.sum(), phi_1.sum()
+
+def alignment_response(d0, theta1, theta2, x_offset, nx=50, ny=50, V=None, k=None):
+    # total amplitude and phase contribution for one tip configuration #
+    tip_space = create_tip_space(d0, theta1, theta2, x_offset, nx, ny, compact=True)
+    return space_response(*tip_space, V=V, k=k)
+
+def offset_frequency_response(x_offsets, omegas, d0=500e-9, theta1=np.radians(30),
+                              theta2=np.radians(15), nx=50, ny=50, V=None, k=None):
+    '''
+    Amplitude and phase of an offset sweep at every drive frequency in
+    omegas, shape (len(x_offsets), len(omegas)). Each tip space is built
+    once and all frequencies are evaluated together.
+    '''
+    separations = []
+    for x_offset in np.ravel(x_offsets):
+        x, y, space, charge_space, surfaces =\
+           create_tip_space(d0, theta1, theta2, x_offset, nx, ny, compact=True)
+        separations.append(get_nearest_separation(surfaces, x, y))
+    A_ov = ((x.max()-x.min())/len(x)) * ((y.max()-y.min())/len(y))
+    return frequency_response(separations, A_ov, omegas, V, k)
+
+def _sweep_block(args):
+    # one block of offsets for one tip geometry #
+    d0, theta1, theta2, x_offsets, nx, ny, cached, store_frames = args
+    if cached:
+        tip_space = cached_tip_space(d0, theta1, theta2, np.abs(x_offsets).max(),
+                                     nx, ny, compact=True)
+    else:
+        tip_space = lambda x_offset: create_tip_space(d0, theta1, theta2, x_offset,
+                                                      nx, ny, compact=True)
+    response = np.empty((2, len(x_offsets)))
+    frames = np.zeros((len(x_offsets), nx, ny), dtype=np.int8) if store_frames else None
+    for n, x_offset in enumerate(x_offsets):
+        x, y, space, charge_space, surfaces = tip_space(x_offset)
+        response[:, n] = space_response(x, y, space, charge_space, surfaces)
+        if store_frames:
+            frames[n] = charge_space
+    return response, frames
+
+def sweep(x_offsets, d0=500e-9, theta1=np.radians(30), theta2=np.radians(15),
+          nx=50, ny=50, processes=None, chunksize=None, cached=False,
+          frames=None):
+    '''
+    Calculate amplitude and phase over every combination of d0, theta1,
+    theta2 and x_offsets. Each parameter may be a scalar or an array; the
+    returned arrays have shape d0.shape + theta1.shape + theta2.shape +
+    x_offsets.shape. Blocks of `chunksize` offsets are spread over
+    `processes` workers by pool_map. With cached=True each block reuses
+    one tip geometry (see cached_tip_space), which rounds offsets to
+    whole grid cells.
+    If frames is a filename the charge_space of every point is saved there
+    as one compressed container for frame_rendering to draw later.
+    '''
+    params = [np.asarray(p, dtype=np.float64) for p in (d0, theta1, theta2, x_offsets)]
+    shape = params[0].shape + params[1].shape + params[2].shape + params[3].shape
+    geometries = list(itertools.product(*[p.ravel() for p in params[:3]]))
+    offsets = params[3].ravel()
+    amplitude = np.empty((len(geometries), len(offsets)))
+    phase = np.empty((len(geometries), len(offsets)))
+    processes = processes or multiprocessing.cpu_count()
+    if chunksize is None:
+        # a few blocks per worker keeps the pool busy without much overhead #
+        n_points = len(geometries) * len(offsets)
+        chunksize = max(1, int(np.ceil(n_points / (4.0 * processes))))
+    blocks = [(g, n, min(n + chunksize, len(offsets)))
+              for g in range(len(geometries))
+              for n in range(0, len(offsets), chunksize)]
+    tasks = [geometries[g] + (offsets[n0:n1], nx, ny, cached, frames is not None)
+             for g, n0, n1 in blocks]
+    if frames is not None:
+        charge_spaces = np.zeros((len(geometries), len(offsets), nx, ny), dtype=np.int8)
+    results = pool_map(_sweep_block, tasks, processes)
+    for (g, n0, n1), (response, block_frames) in zip(blocks, results):
+        amplitude[g, n0:n1] = response[0]
+        phase[g, n0:n1] = response[1]
+        if frames is not None:
+            charge_spaces[g, n0:n1] = block_frames
+    if frames is not None:
+        x, y = create_tip_grid(nx, ny)
+        save_frames(frames, charge_spaces.reshape(shape + (nx, ny)), x, y,
+                    params[3], d0=params[0], theta1=params[1], theta2=params[2])
+    return amplitude.reshape(shape), phase.reshape(shape)
+
+def main(frames=None):
     # define typical starting configuration #
     d0 = 500e-9
     theta1 = np.radians(30)
     theta2 = np.radians(15)
     # typical 1 um grid scan with 50 nm resolution #
     x_offsets = np.arange(-2e-6, 2e-6, 50e-9)
-    # initialise storage arrays for amplitude and phase #
-    amplitude = np.array([])
-    phase = np.array([])
-    # scan tip 1 across tip 2 #
-    k=0.0
-    for x_offset in x_offsets:
-        k+=1.0
-        sys.stdout.write('\r'+str(100*k/len(x_offsets)))
-        sys.stdout.flush()
-        z_m1 = 0; phi_1 = 0
-        # create tip config #
-        x, y, space, charge_space, surfaces =\
-           create_tip_space(d0, theta1, theta2, x_offset)
-
-        # plot #
-        X, Y = np.meshgrid(x, y)
-        Z = charge_space.T
-        c_levels = np.linspace(Z.min(), 1.05*Z.max(), 100)
-        l_levels = np.linspace(Z.min(), 1.05*Z.max(), 10)
-        cmap = cm.Spectral_r
-        norm = cm.colors.Normalize(vmax=Z.max(), vmin=Z.min())
-        lw = 0.5
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        cfax = ax.contourf(X, Y, Z, c_levels,
-                            norm=norm,
-                            alpha=1.0, cmap=cm.get_cmap(cmap, len(c_levels)-1))
-        cb = plt.colorbar(cfax)
-        fname = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),\
-                             'images\\'+str(x_offset))
-        plt.savefig(fname + '.png', bbox_inches=0)
-        plt.close()
-        
-        # determine separation between adjacent points on each tip #
-        A_ov = ((x.max()-x.min())/len(x)) * ((y.max()-y.min())/len(y))
-        d_0s = get_separation(surfaces, x, y)
-        #print 'min $d_0$ =', d_0s.min()
-        # for each separated point determine contribution to oscillation #
-        for d_0 in d_0s:
-            z_m1i, phi_1i = calculate_contribution(d_0, A_ov)
-            z_m1 += z_m1i
-            phi_1 += phi_1i
-        # add total contibution to array #
-        amplitude = np.append(amplitude, z_m1)
-        phase = np.append(phase, phi_1)
+    # scan tip 1 across tip 2 using every core, optionally keeping frames #
+    amplitude, phase = sweep(x_offsets, d0, theta1, theta2, frames=frames)
     return amplitude, phase, x_offsets
 
 if __name__ == '__main__':
-    amplitude, phase, x_offsets = main()
+    # frames are stored during the sweep and rendered afterwards #
+    path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    frames = os.path.join(path, 'frames.npz')
+    amplitude, phase, x_offsets = main(frames)
+    render_frames(frames, os.path.join(path, 'images'))
     # plot #
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -0,0 +1,99 @@
+import numpy as np
+from alignment_simulation import calculate_contribution
+from conductor_creation import create_tip_grid
+
+# Grid-free tips #
+#
+# The tips of create_tips are two wedges whose edges are straight
+# segments from the apex to the edge of the tip space. Here the edges of
+# tip 1 are split into n elements and each element contributes through
+# calculate_contribution with its own length times the tip depth as its
+# area and its distance to the nearest point of tip 2's edges, so no grid
+# is made. Every offset of a sweep is done in one broadcast.
+#
+# The grid model (space_response on an nx by nx create_tip_space) gives
+# every surface pixel one pixel of area, i.e. a depth of one cell, and
+# its stepped edges hold |ux| + |uy| pixels per cell of edge length along
+# a direction (ux, uy). With depth left at one cell the amplitude is the
+# grid model's with straight edges (0.82-0.93 of it at nx=400,
+# correlation 0.994 over a 2 um offset sweep), and the phase is counted
+# per stepped pixel, which matches the grid model's level (1.01 of it).
+# The grid model's phase only changes with offset by single pixel jumps,
+# which the smooth edges here do not reproduce.
+
+# edges are cut off at the extent of create_tip_grid, as in the grid model #
+_x, _y = create_tip_grid(2, 2)
+LOWER = np.array([_x[0], _y[0]])
+UPPER = np.array([_x[-1], _y[-1]])
+
+def tip_segments(d0, theta1, theta2, x_offset):
+    '''
+    Apexes (k,2), unit directions (k,2,2) and lengths (k,2) of the two
+    edges of each tip for an array of k offsets, cut off at the edge of
+    the tip space. Returns tip 1 then tip 2.
+    '''
+    x_offset = np.atleast_1d(np.asarray(x_offset, dtype=np.float64))
+    k = len(x_offset)
+    apex1 = np.column_stack((x_offset, np.full(k, -d0/2)))
+    apex2 = np.tile([0.0, d0/2], (k, 1))
+    dir1 = np.array([(-np.sin(theta1), -np.cos(theta1)), (np.sin(theta2), -np.cos(theta2))])
+    dir2 = np.array([(-np.sin(theta2), np.cos(theta2)), (np.sin(theta1), np.cos(theta1))])
+    segments = []
+    for apex, direction in ((apex1, dir1), (apex2, dir2)):
+        # distance along each edge to the first side of the box it meets #
+        bound = np.where(direction[np.newaxis] > 0, UPPER, LOWER)
+        with np.errstate(divide='ignore'):
+            t = (bound - apex[:, np.newaxis, :]) / direction[np.newaxis]
+        t[:, direction == 0] = np.inf
+        length = np.maximum(t.min(axis=2), 0.0)
+        segments.append((apex, np.broadcast_to(direction, (k, 2, 2)), length))
+    return segments
+
+def _segment_distance(points, apex, direction, length):
+    # distance from points (k,m,2) to the nearer of two segments per offset #
+    distance = np.inf
+    for e in range(2):
+        d = direction[:, np.newaxis, e]
+        rel = points - apex[:, np.newaxis]
+        t = np.clip((rel * d).sum(axis=2), 0.0, length[:, e, np.newaxis])
+        distance = np.minimum(distance, np.sqrt(((rel - t[..., np.newaxis]*d)**2).sum(axis=2)))
+    return distance
+
+def edge_samples(d0, theta1, theta2, x_offset, n=200):
+    '''
+    Midpoints (k,2n,2) and lengths (k,2n) of n elements along each edge of
+    tip 1, and their distances (k,2n) to tip 2, for k offsets.
+    '''
+    (apex1, dir1, length1), tip2 = tip_segments(d0, theta1, theta2, x_offset)
+    s = (np.arange(n) + 0.5) / n
+    # (k, edge, element) distance along the edge, then the points themselves #
+    t = length1[:, :, np.newaxis] * s
+    points = apex1[:, np.newaxis, np.newaxis] + t[..., np.newaxis] * dir1[:, :, np.newaxis]
+    points = points.reshape(len(apex1), 2*n, 2)
+    ds = np.repeat(length1 / n, n, axis=1)
+    return points, ds, _segment_distance(points, *tip2)
+
+def analytic_response(x_offsets, d0=500e-9, theta1=np.radians(30), theta2=np.radians(15),
+                      n=200, depth=None, nx=400, V=None, k=None, omega=None):
+    '''
+    Amplitude and phase for every offset in x_offsets from the analytic
+    tip edges, each of shape x_offsets.shape. Elements are n per edge and
+    have an area of their length times depth, the depth of the tips in m.
+    depth defaults to one cell of the nx by nx tip space, which is the
+    grid model the outputs compare with (see the module notes). The
+    phase is counted per pixel of that grid, so neither output depends
+    on n.
+    '''
+    x_offsets = np.asarray(x_offsets, dtype=np.float64)
+    x, y = create_tip_grid(nx, nx)
+    cell = x[1] - x[0]
+    if depth is None:
+        depth = cell
+    points, ds, d_0s = edge_samples(d0, theta1, theta2, x_offsets.ravel(), n)
+    z_m1, phi_1 = calculate_contribution(d_0s, ds * depth, V, k, omega)
+    # the pixel model sums one phase per stepped surface pixel #
+    direction = tip_segments(d0, theta1, theta2, x_offsets.ravel())[0][1]
+    pixels = np.repeat(np.abs(direction).sum(axis=2), n, axis=1) * ds / cell
+    phi_1 = phi_1 * pixels
+    return (z_m1.sum(axis=1).reshape(x_offsets.shape),
+            phi_1.sum(axis=1).reshape(x_offsets.shape))
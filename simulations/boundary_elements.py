@@ -0,0 +1,93 @@
+import time
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from conductor_creation import surface_coordinates
+from potential_simulation import eps_0, V_0, grid_spacing, direct_sum
+
+# Boundary elements for the surface charge on the tips #
+#
+# Each surface point from charge_distribution is a square element of one
+# grid cell carrying an unknown charge. Collocation at the element centres
+# asks the potential of all the charges to be +V on tip 1 and -V on tip 2:
+# G q = V, with G_ij = 1/(4 pi eps_0 r_ij) off the diagonal and, on it, the
+# potential at the centre of a uniformly charged square of side h,
+# 4 ln(1 + sqrt(2)) / (4 pi eps_0 h). G is symmetric positive definite, so
+# it is solved by blocks: the Cholesky factor of the tip 2 block is kept
+# between offsets (tip 2 does not move), and only the tip 1 Schur
+# complement is factorised for each offset.
+
+SELF_TERM = 4 * np.log(1 + np.sqrt(2))
+
+def influence_matrix(targets, sources, h, block=2048):
+    '''
+    Dense influence matrix (n,m) of unit charges at sources (m,2) on the
+    potential at targets (n,2), built in row blocks of `block` targets.
+    Coincident points get the self term of a square element of side h.
+    '''
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+    sources = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+    G = np.empty((len(targets), len(sources)))
+    for start in range(0, len(targets), block):
+        stop = min(start + block, len(targets))
+        r = np.hypot(targets[start:stop, 0, np.newaxis] - sources[np.newaxis, :, 0],
+                     targets[start:stop, 1, np.newaxis] - sources[np.newaxis, :, 1])
+        same = r == 0
+        r[same] = 1.0
+        G[start:stop] = 1.0 / r
+        G[start:stop][same] = SELF_TERM / h
+    G /= 4*np.pi*eps_0
+    return G
+
+def bem_solver(x, y, V=V_0):
+    '''
+    Boundary element solver for the tip spaces on grid x, y. Returns
+    solve(surfaces), taking the compact (or legacy) surfaces of tip 1 and
+    tip 2 and returning a dict with the element positions and charges of
+    each tip and a report (element counts, whether the tip 2 factor came
+    from the cache, wall time). The tip 2 factor is reused while the tip 2
+    surface is unchanged.
+    '''
+    h = np.sqrt(grid_spacing(x) * grid_spacing(y))
+    cache = {'key': None, 'factor': None}
+
+    def solve(surfaces):
+        start = time.time()
+        p1 = surface_coordinates(surfaces[0], x, y)
+        p2 = surface_coordinates(surfaces[1], x, y)
+        key = p2.tobytes()
+        cached = key == cache['key']
+        if not cached:
+            cache['factor'] = cho_factor(influence_matrix(p2, p2, h), lower=True)
+            cache['key'] = key
+        factor = cache['factor']
+        V1 = np.full(len(p1), float(V)); V2 = np.full(len(p2), -float(V))
+        G11 = influence_matrix(p1, p1, h)
+        G21 = influence_matrix(p2, p1, h)
+        # eliminate tip 2: (G11 - G12 G22^-1 G21) q1 = V1 - G12 G22^-1 V2 #
+        X = cho_solve(factor, np.column_stack((G21, V2)))
+        S = G11 - G21.T.dot(X[:, :-1])
+        q1 = cho_solve(cho_factor(S, lower=True), V1 - G21.T.dot(X[:, -1]))
+        q2 = X[:, -1] - X[:, :-1].dot(q1)
+        report = {'n1': len(p1), 'n2': len(p2), 'cached': cached,
+                  'time': time.time() - start}
+        return {'points': [p1, p2], 'charges': [q1, q2], 'report': report}
+
+    return solve
+
+def calculate_potential_bem(space, x, y, surfaces, V=V_0, solve=None):
+    '''
+    Potential on the grid from self-consistent surface charges: +V in tip 1
+    (space > 0), -V in tip 2 (space < 0) and the direct sum of the solved
+    charges elsewhere. Pass a solve from bem_solver to reuse its tip 2
+    factor across offsets. Returns the potential and the solution dict.
+    '''
+    if solve is None:
+        solve = bem_solver(x, y, V)
+    solution = solve(surfaces)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    outside = space == 0
+    potential = V * np.sign(space).astype(np.float64)
+    potential[outside] = direct_sum(np.column_stack((X[outside], Y[outside])),
+                                    np.concatenate(solution['points']),
+                                    np.concatenate(solution['charges']))[0]
+    return potential, solution
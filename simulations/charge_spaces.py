@@ -1,4 +1,140 @@
 import numpy as np
+from conductor_creation import rasterize, surface_mask
+from potential_simulation import eps_0, V_0, grid_spacing, potential_solver, conductor_potential,\
+     calculate_potential_fft, calculate_field_fft
+
+# Charge spaces #
+#
+# A ChargeSpace is a uniform (x, y) grid with an array of charge per cell,
+# indexed charge[i][j] -> (x[i], y[j]) like every other space. Point
+# charges are deposited in bulk with scattered adds (np.add.at), either on
+# the nearest grid point (ngp) or shared between the four surrounding
+# points by area (cic, cloud in cell). Objects are vectorised masks, as
+# made by create_tip_masks, and fill or coat their cells with charge. The
+# charge array is what calculate_potential_fft takes as charge_space, and
+# as a density it is the source term of the sparse and multigrid solvers.
+
+class ChargeSpace:
+    def __init__(self, x, y):
+        '''
+        Empty charge space on the uniformly spaced axes x and y.
+        '''
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.dx = grid_spacing(self.x); self.dy = grid_spacing(self.y)
+        self.charge = np.zeros((len(self.x), len(self.y)), dtype=np.float64)
+
+    @property
+    def shape(self):
+        return self.charge.shape
+
+    def _grid_position(self, xi, yi):
+        # fractional grid indices of the points, which must lie on the grid #
+        xi = np.ravel(xi); yi = np.ravel(yi)
+        outside = (xi < self.x[0]) | (xi > self.x[-1]) | (yi < self.y[0]) | (yi > self.y[-1])
+        if np.any(outside):
+            raise ValueError("%d point charges are outside the grid space" % np.sum(outside))
+        # round off can put points on the far edge just past the last index #
+        nx, ny = self.shape
+        u = np.clip((xi - self.x[0]) / self.dx, 0, nx - 1)
+        v = np.clip((yi - self.y[0]) / self.dy, 0, ny - 1)
+        return u, v
+
+    def add_charges(self, q, xi, yi, weighting='cic'):
+        '''
+        Deposit point charges q at (xi, yi), all arrays (or scalars, which
+        are broadcast), in one pass. weighting is 'ngp' (whole charge on
+        the nearest grid point) or 'cic' (bilinear share between the four
+        grid points around each charge). Total charge is kept either way.
+        Returns self so deposits can be chained.
+        '''
+        q, xi, yi = np.broadcast_arrays(np.asarray(q, dtype=np.float64), xi, yi)
+        u, v = self._grid_position(xi, yi)
+        q = q.ravel()
+        if weighting == 'ngp':
+            np.add.at(self.charge, (np.rint(u).astype(np.intp), np.rint(v).astype(np.intp)), q)
+        elif weighting == 'cic':
+            nx, ny = self.shape
+            # lower corner of each cell, kept one short of the far edge #
+            i = np.minimum(np.floor(u).astype(np.intp), max(nx - 2, 0))
+            j = np.minimum(np.floor(v).astype(np.intp), max(ny - 2, 0))
+            fu = u - i; fv = v - j
+            for di, wu in ((0, 1 - fu), (1, fu)):
+                for dj, wv in ((0, 1 - fv), (1, fv)):
+                    np.add.at(self.charge, (i + di, j + dj), q * wu * wv)
+        else:
+            raise ValueError("unknown weighting %r" % weighting)
+        return self
+
+    def add_point_charge(self, q, xi, yi, weighting='cic'):
+        '''
+        Add a single point charge q at (xi, yi), weighted as in add_charges.
+        '''
+        return self.add_charges(q, xi, yi, weighting)
+
+    def object_mask(self, *mask_funcs):
+        '''
+        Union of the vectorised object masks mask_funcs(X, Y) on this grid.
+        '''
+        mask = np.zeros(self.shape, dtype=bool)
+        for mask_func in mask_funcs:
+            mask |= rasterize(mask_func, self.x, self.y)
+        return mask
+
+    def add_object(self, mask_func, q=1.0, surface=False):
+        '''
+        Add charge q to every cell of the object mask_func(X, Y), or with
+        surface=True only to its surface cells (the cells charged by
+        extract_surface). Returns self.
+        '''
+        mask = self.object_mask(mask_func)
+        if surface:
+            mask = surface_mask(mask.astype(np.int8))
+        self.charge[mask] += q
+        return self
+
+    def total_charge(self):
+        return self.charge.sum()
+
+    def density(self, depth=1.0):
+        # charge per unit volume of each cell, a cell being depth deep #
+        return self.charge / (self.dx * self.dy * depth)
+
+    def potential_fft(self, space=None):
+        '''
+        Free space potential of the charges as point charges, by FFT
+        convolution (calculate_potential_fft). Conductor interiors of space,
+        if given, are zeroed.
+        '''
+        if space is None:
+            space = np.zeros(self.shape)
+        return calculate_potential_fft(space, self.x, self.y, self.charge)
+
+    def field_fft(self, space=None):
+        # field (Ex, Ey) of the charges, as calculate_field_fft #
+        if space is None:
+            space = np.zeros(self.shape)
+        return calculate_field_fft(space, self.x, self.y, self.charge)
+
+    def source(self, depth=1.0):
+        '''
+        Source term f of lap(V) = f for the charges, -density/eps_0, in the
+        form taken by the sparse and multigrid solves.
+        '''
+        return -self.density(depth) / eps_0
+
+    def potential(self, space=None, V=V_0, depth=1.0, solve=None):
+        '''
+        Potential of the charges with the conductors in space held at +/-V
+        and the grid edge grounded, from Poisson's equation with each cell
+        depth deep. solve is a potential_solver solve (the default) or a
+        multigrid solve for the same space; its result is returned as is.
+        '''
+        if space is None:
+            space = np.zeros(self.shape)
+        if solve is None:
+            solve = potential_solver(space, self.x, self.y)
+        return solve(conductor_potential(space, V), self.source(depth))
 
 # Create empty charge spaces #
 
@@ -6,85 +142,12 @@ def create_space(x1, x2, y1, y2, dx, dy):
     '''
     Create a space with size (x2-x1,y2-y1) and grid spacings (dx,dy).
     '''
-    n = (x2 - x1)/dx
-    m = (y2 - y1)/dy
-    space = create_space_step(x1,x2,y1,y2,n,m):
-    return space
+    n = int(round((x2 - x1)/dx)) + 1
+    m = int(round((y2 - y1)/dy)) + 1
+    return create_space_step(x1, x2, y1, y2, n, m)
 
 def create_space_step(x1, x2, y1, y2, n, m):
     '''
     Create a space with size (x2-x1,y2-y1) and (n,m) grid entries.
     '''
-    x = np.linspace(x1,x2,n)
-    y = np.linspace(y1,y2,m)
-    space = create_space_nm(n,m)
-    return space
-
-def create_space_nm(n, m):
-    '''
-    Create an nxm grid space
-    '''
-    space = np.zeros((n,m), dtype=np.float64)
-    return space
-
-# Add objects to charge spaces #
-
-def add_object(object_func, space):
-    '''
-    Add the object described by object_func to the given space.
-    '''
-    new_space = np.array(space)
-    # add objects to space #
-    for i in range(len(x)):
-        for j in range(len(y)):
-            new_space[i][j] += object_func(x[i], y[j])
-    return new_space
-
-## Objects (charge) functions ##
-
-def add_point_charge(q, xi, yi, x, y, space):
-    '''
-    Add a point charge q at position (xi,yi) to the given space.
-    '''
-    ### error handling - point charge must be within grid space ###
-    if xi > x.max() or xi < x.min() or\
-       yi > y.max() or yi < y.min():
-        return -1
-    ### get grid index to place charge ###
-    new_space = np.array(space)
-    x_index = np.where(x==xi)
-    y_index = np.where(y==yi)
-    if x_index == []:
-        delta = [abs(i - xi) for i in x]
-        x_index = np.where(x==x.min())
-    elif y_index = []
-        delta = [abs(i - yi) for i in y]
-        y_index = np.where(y==y.min())
-    ### add charge to space ###
-    new_space[x_index,y_index] = q
-    return new_space
-
-def create_tips(d0, theta1, theta2, x_offset):
-    def create_tip1(x,y):
-        # left (x < 0) tip surface defined by equation  #
-        # y - (1.0/np.tan(theta1))*x + d0/2 = 0         #
-        if (y - (1.0/np.tan(theta1))*(x-x_offset) + d0/2) <= 0 and (x-x_offset) < 0:
-            return 1
-        # right (x >= 0) tip surface defined by equation  #
-        # y + (1.0/np.tan(theta2))*x + d0/2 = 0           #
-        elif y + (1.0/np.tan(theta2))*(x-x_offset) + d0/2 <= 0 and (x-x_offset) >= 0:
-            return 1
-        else:
-            return 0
-    def create_tip2(x,y):
-        # left (x < 0) tip surface defined by equation  #
-        # y + (1.0/np.tan(theta2))*x - d0/2 = 0         #
-        if y + (1.0/np.tan(theta2))*x - d0/2 >= 0 and x < 0:
-            return -1
-        # right (x >= 0) tip surface defined by equation  #
-        # y - (1.0/np.tan(theta1))*x - d0/2 = 0           #
-        elif y - (1.0/np.tan(theta1))*x - d0/2 >= 0 and x >= 0:
-            return -1
-        else:
-            return 0
-    return create_tip1, create_tip2
+    return ChargeSpace(np.linspace(x1, x2, n), np.linspace(y1, y2, m))
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import ndimage
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib import rc
@@ -45,6 +46,45 @@ def create_plates(d0):
             return 0
     return create_plate1, create_plate2
 
+# vectorised 2d shapes (same inequalities, evaluated on whole grids) #
+
+def create_tip_masks(d0, theta1, theta2, x_offset):
+    def tip1_mask(X, Y):
+        # left and right surfaces of tip 1, as in create_tip1 #
+        left = (Y - (1.0/np.tan(theta1))*(X-x_offset) + d0/2 <= 0) & ((X-x_offset) < 0)
+        right = (Y + (1.0/np.tan(theta2))*(X-x_offset) + d0/2 <= 0) & ((X-x_offset) >= 0)
+        return left | right
+    def tip2_mask(X, Y):
+        # left and right surfaces of tip 2, as in create_tip2 #
+        left = (Y + (1.0/np.tan(theta2))*X - d0/2 >= 0) & (X < 0)
+        right = (Y - (1.0/np.tan(theta1))*X - d0/2 >= 0) & (X >= 0)
+        return left | right
+    return tip1_mask, tip2_mask
+
+def create_tip_levels(d0, theta1, theta2, x_offset):
+    # signed level functions of the tips, inside where the level is <= 0 #
+    def tip1_level(X, Y):
+        u = X - x_offset
+        return Y + d0/2 + np.where(u < 0, -u/np.tan(theta1), u/np.tan(theta2))
+    def tip2_level(X, Y):
+        return d0/2 - Y + np.where(X < 0, -X/np.tan(theta2), X/np.tan(theta1))
+    return tip1_level, tip2_level
+
+def create_plate_masks(d0):
+    def plate1_mask(X, Y):
+        return (Y + d0/2 <= 0) & np.ones_like(X, dtype=bool)
+    def plate2_mask(X, Y):
+        return (Y - d0/2 <= 0) & np.ones_like(X, dtype=bool)
+    return plate1_mask, plate2_mask
+
+def rasterize(mask_func, x, y):
+    '''
+    Evaluate a vectorised object mask over the (x,y) grid in one pass.
+    Returns a boolean array indexed as space[i][j] -> (x[i], y[j]).
+    '''
+    # broadcast columns against rows rather than building a full meshgrid #
+    return mask_func(x[:, np.newaxis], y[np.newaxis, :])
+
 def add_object(object_func, x, y, space):
     new_space = np.array(space)
     # add objects to space #
@@ -53,56 +93,117 @@ def add_object(object_func, x, y, space):
             new_space[i][j] += object_func(x[i], y[j])
     return new_space
 
-def charge_distribution(object_name, x, y, space):
+def charge_distribution(object_name, x, y, space, compact=False):
     # find surfaces storing charge #
-    charge_space = np.zeros_like(space)
-    surface = np.array([]).reshape(0,3)
-    if object_name == "tip1":
-        q = 1.0
-    else:
-        q = -1.0
-    for i in range(len(x)):
-        for j in range(len(y)):
-            il = i-1 if (i-1 >= 0) else 0
-            iu = i+1 if (i+1 < len(x)) else i
-            jl = j-1 if (j-1 >= 0) else 0
-            ju = j+1 if (j+1 < len(y)) else j
-            sur_space = space[il:iu+1,jl:ju+1]
-            if space[i][j] == 1 and 1 in sur_space and 0 in sur_space:
-                charge_space[i][j] = q
-                row = np.array([i, j, q]).reshape(1,3)
-                surface = np.append(surface, row, axis=0)               
-    return charge_space, surface
-
-def create_tip_space(d0, theta1, theta2, x_offset):
-    # create grid space and dimension scaling #
-    nx = 50; ny = 50; nz = 11
+    charge_space, index, charge = extract_surface(object_name, space)
+    if compact:
+        return charge_space, (index, charge)
+    # legacy layout: float charge space and rows of [i, j, q] #
+    surface = np.column_stack((index, charge)).astype(np.float64)
+    return charge_space.astype(np.float64), surface
+
+def surface_mask(space):
+    '''
+    Boolean mask of the surface cells of an object: cells equal to 1 with
+    at least one empty (0) cell in their 3x3 neighbourhood. The
+    neighbourhood is clipped at the grid edges, so edges are not surfaces.
+    '''
+    empty = (space == 0)
+    # dilation with a 3x3 block marks every cell touching an empty cell #
+    near_empty = ndimage.binary_dilation(empty, structure=np.ones((3,3), dtype=bool))
+    return (space == 1) & near_empty
+
+def extract_surface(object_name, space):
+    '''
+    Vectorised surface extraction. Returns an int8 charge space, an (n,2)
+    int32 array of surface indices (i, j) in row-major order and an (n,)
+    int8 array of the charge on each surface point.
+    '''
+    q = 1 if object_name == "tip1" else -1
+    mask = surface_mask(space)
+    index = np.argwhere(mask).astype(np.int32)
+    charge = np.full(index.shape[0], q, dtype=np.int8)
+    charge_space = np.zeros(space.shape, dtype=np.int8)
+    charge_space[mask] = q
+    return charge_space, index, charge
+
+def split_surface(surface):
+    '''
+    Return (index, charge) for a surface in either the compact
+    (index, charge) form or the legacy [i, j, q] row form.
+    '''
+    if isinstance(surface, tuple):
+        index, charge = surface
+        return np.asarray(index, dtype=np.int32), np.asarray(charge)
+    surface = np.asarray(surface).reshape(-1, 3)
+    return surface[:, :2].astype(np.int32), surface[:, 2]
+
+def surface_coordinates(surface, x, y):
+    # (n,2) array of the (x,y) positions of a surface's points #
+    index, _ = split_surface(surface)
+    return np.column_stack((x[index[:,0]], y[index[:,1]]))
+
+def create_tip_grid(nx=50, ny=50):
+    # grid used for all tip spaces #
     x = np.linspace(-5e-6, 5e-6, nx)
     y = np.linspace(-5e-6, 5e-6, ny)
+    return x, y
+
+def create_tip_space(d0, theta1, theta2, x_offset, nx=50, ny=50, compact=False):
+    # create grid space and dimension scaling #
+    nz = 11
+    x, y = create_tip_grid(nx, ny)
     z = np.linspace(-10e-6, 10e-6, nz)
     space = np.zeros((nx,ny))    # 2d space used for quick planar sims #
 
     # create objects #
-    create_tip1, create_tip2 = create_tips(d0, theta1, theta2, x_offset)
-    surfaces = np.array([])
-    surface = np.array([])
-    
+    tip1_mask, tip2_mask = create_tip_masks(d0, theta1, theta2, x_offset)
+
     # add objects to space #
-    charge_space = np.zeros_like(space)
+    charge_space = np.zeros(space.shape, dtype=np.int8 if compact else np.float64)
     surfaces = []
     # tip 1
-    t1_space = add_object(create_tip1, x, y, space)
-    charge_space_1, charge_surface = charge_distribution('tip1', x, y, t1_space)
+    t1_space = rasterize(tip1_mask, x, y).astype(np.int8)
+    charge_space_1, charge_surface = charge_distribution('tip1', x, y, t1_space, compact)
     charge_space += charge_space_1
     surfaces.append(charge_surface)
-    t2_space = add_object(create_tip2, x, y, space)
-    charge_space_2, charge_surface = charge_distribution('tip2', x, y, t2_space)
+    t2_space = rasterize(tip2_mask, x, y).astype(np.int8)
+    charge_space_2, charge_surface = charge_distribution('tip2', x, y, t2_space, compact)
     charge_space += charge_space_2
     surfaces.append(charge_surface)
     space += t1_space
-    space += t2_space
+    space -= t2_space
     return x, y, space, charge_space, surfaces
 
+def cached_tip_space(d0, theta1, theta2, max_offset, nx=50, ny=50, compact=False):
+    '''
+    Cached geometry version of create_tip_space for sweeps over x_offset.
+    Tip 2 (mask, charge space and surface) is built once, and tip 1 is
+    rasterized once on an x axis extended by max_offset either side.
+    Returns tip_space(x_offset), which gives the same outputs as
+    create_tip_space by slicing the tip 1 mask. Offsets are rounded to a
+    whole number of grid cells.
+    '''
+    x, y = create_tip_grid(nx, ny)
+    dx = x[1] - x[0]
+    pad = int(np.ceil(abs(max_offset) / dx)) + 1
+    x_ext = x[0] + dx * np.arange(-pad, nx + pad)
+    tip1_mask, tip2_mask = create_tip_masks(d0, theta1, theta2, 0.0)
+    t1_ext = rasterize(tip1_mask, x_ext, y).astype(np.int8)
+    t2_space = rasterize(tip2_mask, x, y).astype(np.int8)
+    charge_space_2, surface_2 = charge_distribution('tip2', x, y, t2_space, compact)
+    def tip_space(x_offset):
+        k = int(round(x_offset / dx))
+        if abs(k) > pad:
+            raise ValueError("x_offset %g is outside the cached range %g" % (x_offset, max_offset))
+        # tip 1 at an offset of k cells is the base mask moved k cells along x #
+        t1_space = t1_ext[pad - k:pad - k + nx]
+        charge_space_1, surface_1 = charge_distribution('tip1', x, y, t1_space, compact)
+        charge_space = charge_space_1 + charge_space_2
+        space = t1_space - t2_space.astype(np.float64)
+        return x, y, space, charge_space, [surface_1, surface_2]
+    return tip_space
+
 if __name__ == '__main__':
     # define object parameters #
     d0 = 2.0
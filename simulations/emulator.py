@@ -0,0 +1,121 @@
+import time
+import json
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from alignment_simulation import alignment_response
+from process_pool import pool_map
+from sweep_cache import PARAMETERS, DEFAULTS, run_sweep
+
+# Lookup table emulator for the alignment forward model #
+#
+# A table holds amplitude and phase over a regular grid of some of the
+# sweep parameters (the axes), with the others held fixed. The emulator
+# interpolates the table so a query costs microseconds per point instead
+# of building a tip space. Tables are computed through run_sweep, so the
+# points are cached on disk and an interrupted build resumes.
+
+def build_table(cache_dir, nx=50, ny=50, processes=None, **params):
+    '''
+    Forward model table over the parameters in PARAMETERS. Parameters
+    given as 1d arrays of two or more increasing values become axes of the
+    table, scalars (and missing parameters, from DEFAULTS) are held fixed.
+    Returns a dict with the axis names and values, the fixed values, the
+    grid size and the amplitude and phase arrays.
+    '''
+    axes = []; values = []; fixed = {}
+    for name in PARAMETERS:
+        value = np.asarray(params.get(name, DEFAULTS[name]), dtype=np.float64)
+        if value.size > 1:
+            if value.ndim != 1 or np.any(np.diff(value) <= 0):
+                raise ValueError("%s must be a 1d array of increasing values" % name)
+            axes.append(name); values.append(value)
+        else:
+            fixed[name] = float(value)
+    if not axes:
+        raise ValueError("a table needs at least one parameter array")
+    sweep_params = dict(fixed)
+    sweep_params.update(zip(axes, values))
+    result = run_sweep(cache_dir, nx, ny, processes, **sweep_params)
+    return {'axes': axes, 'values': values, 'fixed': fixed, 'nx': nx, 'ny': ny,
+            'amplitude': result['amplitude'], 'phase': result['phase']}
+
+def save_table(fname, table):
+    # one compressed .npz, with the axis values stored as axis_<name> #
+    arrays = dict(('axis_' + name, value) for name, value in zip(table['axes'], table['values']))
+    info = {'axes': table['axes'], 'fixed': table['fixed'], 'nx': table['nx'], 'ny': table['ny']}
+    np.savez_compressed(fname, amplitude=table['amplitude'], phase=table['phase'],
+                        info=json.dumps(info), **arrays)
+
+def load_table(fname):
+    with np.load(fname) as data:
+        info = json.loads(str(data['info']))
+        info['values'] = [data['axis_' + name] for name in info['axes']]
+        info['amplitude'] = data['amplitude']
+        info['phase'] = data['phase']
+    return info
+
+def create_emulator(table, method='linear'):
+    '''
+    Interpolating emulator for a table (dict or saved filename). Returns
+    emulate(*values), taking one scalar or array per table axis in the
+    table's axis order (broadcast together), and returning amplitude and
+    phase with the broadcast shape. Points outside the table raise
+    ValueError.
+    '''
+    if not isinstance(table, dict):
+        table = load_table(table)
+    values = tuple(table['values'])
+    amplitude = RegularGridInterpolator(values, table['amplitude'], method=method)
+    phase = RegularGridInterpolator(values, table['phase'], method=method)
+    def emulate(*point):
+        if len(point) != len(values):
+            raise ValueError("expected values for %s" % ', '.join(table['axes']))
+        point = np.broadcast_arrays(*[np.asarray(p, dtype=np.float64) for p in point])
+        shape = point[0].shape
+        xi = np.column_stack([p.ravel() for p in point])
+        return amplitude(xi).reshape(shape), phase(xi).reshape(shape)
+    return emulate
+
+def _full_model(args):
+    # full model response at one table point and the time it took #
+    point, nx, ny = args
+    start = time.time()
+    response = alignment_response(point['d0'], point['theta1'], point['theta2'],
+                                  point['x_offset'], nx, ny, V=point['V_0'], k=point['k_0'])
+    return response, time.time() - start
+
+def emulator_error(table, n_samples=50, seed=0, processes=None, method='linear'):
+    '''
+    Error of the emulator against the full model at n_samples random
+    points inside the table. Returns the maximum and rms absolute errors
+    of amplitude and phase, each also relative to the largest table value,
+    and the time per query of the emulator and of the full model. Model
+    points may run on a pool, but each is timed inside its worker, so
+    model_time is the cost of one point whatever the number of workers.
+    '''
+    if not isinstance(table, dict):
+        table = load_table(table)
+    emulate = create_emulator(table, method)
+    rng = np.random.RandomState(seed)
+    samples = [rng.uniform(v[0], v[-1], n_samples) for v in table['values']]
+    points = []
+    for n in range(n_samples):
+        point = dict(table['fixed'])
+        point.update((name, s[n]) for name, s in zip(table['axes'], samples))
+        points.append(point)
+    tasks = [(point, table['nx'], table['ny']) for point in points]
+    results = pool_map(_full_model, tasks, processes)
+    full = np.array([response for response, seconds in results]).T
+    model_time = np.mean([seconds for response, seconds in results])
+    start = time.time()
+    emulated = np.array(emulate(*samples))
+    emulator_time = (time.time() - start) / n_samples
+    report = {'model_time': model_time, 'emulator_time': emulator_time}
+    for n, name in enumerate(('amplitude', 'phase')):
+        error = np.abs(emulated[n] - full[n])
+        scale = np.abs(table[name]).max() or 1.0
+        report[name + '_max_error'] = error.max()
+        report[name + '_rms_error'] = np.sqrt((error**2).mean())
+        report[name + '_max_relative_error'] = error.max() / scale
+        report[name + '_rms_relative_error'] = np.sqrt((error**2).mean()) / scale
+    return report
@@ -0,0 +1,110 @@
+import os
+import numpy as np
+from matplotlib import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from process_pool import pool_map
+
+# Store sweep frames #
+
+def save_frames(fname, charge_space, x, y, x_offsets, **params):
+    '''
+    Save the charge_space frames of a sweep into one compressed .npz
+    container. charge_space has shape (..., len(x_offsets), nx, ny); any
+    extra keyword arrays (d0, theta1, ...) are stored alongside.
+    '''
+    np.savez_compressed(fname, charge_space=charge_space, x=x, y=y,
+                        x_offsets=x_offsets, **params)
+
+def load_frames(fname):
+    '''
+    Load a frame container written by save_frames as a dict of arrays.
+    '''
+    with np.load(fname) as data:
+        return dict((key, data[key]) for key in data.files)
+
+def frame_names(frames):
+    # 1d offset sweeps keep the old naming by offset, others are numbered #
+    charge_space = frames['charge_space']
+    x_offsets = frames['x_offsets']
+    if x_offsets.ndim == 1 and charge_space.shape[:-2] == x_offsets.shape:
+        return [str(x_offset) for x_offset in x_offsets]
+    n = int(np.prod(charge_space.shape[:-2]))
+    return ['frame_%05d' % i for i in range(n)]
+
+# Render frames #
+
+def frame_levels(charge_space, n=100):
+    # one set of contour levels for every frame so colours are comparable #
+    zmin = float(charge_space.min()); zmax = float(charge_space.max())
+    if zmax <= zmin:
+        zmax = zmin + 1.0
+    return np.linspace(zmin, 1.05*zmax, n)
+
+def plot_frame(x, y, charge_space, c_levels, fname):
+    '''
+    Plot a single charge space frame and save it as fname + '.png'.
+    Uses the Agg canvas directly so it is safe to run in worker processes.
+    '''
+    X, Y = np.meshgrid(x, y)
+    Z = charge_space.T
+    norm = cm.colors.Normalize(vmax=c_levels[-1], vmin=c_levels[0])
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    cfax = ax.contourf(X, Y, Z, c_levels, norm=norm, alpha=1.0,
+                       cmap=cm.Spectral_r)
+    fig.colorbar(cfax)
+    fig.savefig(fname + '.png', bbox_inches=0)
+    return fname + '.png'
+
+def _plot_frame(args):
+    # plot_frame on one packed task #
+    return plot_frame(*args)
+
+def render_frames(frames, out_dir, processes=None):
+    '''
+    Render every frame in a container (filename or loaded dict) to a png
+    in out_dir, spread over `processes` workers by pool_map. Returns the
+    image filenames.
+    '''
+    if not isinstance(frames, dict):
+        frames = load_frames(frames)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    x = frames['x']; y = frames['y']
+    charge_space = frames['charge_space']
+    c_levels = frame_levels(charge_space)
+    charge_space = charge_space.reshape((-1,) + charge_space.shape[-2:])
+    tasks = [(x, y, Z, c_levels, os.path.join(out_dir, name))
+             for Z, name in zip(charge_space, frame_names(frames))]
+    return pool_map(_plot_frame, tasks, processes)
+
+def render_animation(frames, out_file, fps=10):
+    '''
+    Render every frame in a container (filename or loaded dict) into a
+    single animation. A .gif is written with Pillow; other extensions use
+    matplotlib's default movie writer (ffmpeg).
+    '''
+    from matplotlib import animation
+    if not isinstance(frames, dict):
+        frames = load_frames(frames)
+    x = frames['x']; y = frames['y']
+    charge_space = frames['charge_space']
+    charge_space = charge_space.reshape((-1,) + charge_space.shape[-2:])
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    extent = [x.min(), x.max(), y.min(), y.max()]
+    im = ax.imshow(charge_space[0].T, origin='lower', extent=extent,
+                   vmin=charge_space.min(), vmax=charge_space.max(),
+                   cmap=cm.Spectral_r, aspect='auto')
+    fig.colorbar(im)
+    def update(n):
+        im.set_data(charge_space[n].T)
+        return im,
+    anim = animation.FuncAnimation(fig, update, frames=len(charge_space),
+                                   interval=1000.0/fps, blit=False)
+    writer = 'pillow' if out_file.endswith('.gif') else None
+    anim.save(out_file, writer=writer, fps=fps)
+    return out_file
@@ -0,0 +1,222 @@
+import time
+import itertools
+import numpy as np
+from scipy.sparse.linalg import splu
+from potential_simulation import V_0, fixed_cells, conductor_potential, laplacian_matrix,\
+     grid_spacing
+
+# Geometric multigrid for the Dirichlet problem on tip spaces #
+#
+# Grids are vertex centred: coarse point I sits on fine point 2I. The
+# space is padded with fixed (grounded) cells up to m*2**(levels-1)+1
+# points per axis so every level nests exactly; as the grid edge is
+# already held fixed the padding does not change the solution. Each level
+# only stores its fixed-cell mask, working arrays are made per cycle.
+# Everything works on 2d and 3d grids alike.
+
+def _padded_size(n, levels):
+    step = 2**(levels - 1)
+    return int(np.ceil((n - 1) / float(step))) * step + 1
+
+def _count_levels(shape, coarsest):
+    levels = 1
+    while max(_padded_size(n, levels) for n in shape) > coarsest * 2**(levels - 1) + 1:
+        levels += 1
+    return levels
+
+def _shifted(axis, ndim, lo, hi):
+    # interior slice along every axis except `axis`, which runs lo:hi #
+    index = [slice(1, -1)] * ndim
+    index[axis] = slice(lo, hi)
+    return tuple(index)
+
+def apply_laplacian(u, h):
+    # 5-point (7-point in 3d) Laplacian on the interior, zero on the edge #
+    Lu = np.zeros_like(u)
+    centre = u[(slice(1, -1),) * u.ndim]
+    interior = Lu[(slice(1, -1),) * u.ndim]
+    for axis in range(u.ndim):
+        interior += (u[_shifted(axis, u.ndim, 2, None)] - 2*centre +
+                     u[_shifted(axis, u.ndim, None, -2)]) / h[axis]**2
+    return Lu
+
+def residual(u, f, free, h):
+    r = f - apply_laplacian(u, h)
+    r[~free] = 0.0
+    return r
+
+def _color_slices(n, start):
+    # interior points start, start+2, ... with their two neighbours #
+    k = len(range(start, n - 1, 2))
+    return (slice(start, start + 2*k, 2), slice(start + 1, start + 1 + 2*k, 2),
+            slice(start - 1, start - 1 + 2*k, 2))
+
+def smooth(u, f, free, h, colors=(0, 1)):
+    '''
+    Red-black Gauss-Seidel sweep, in place. Points whose index sum has
+    parity equal to each entry of colors are updated in turn; fixed cells
+    are skipped.
+    '''
+    diag = sum(2.0/hk**2 for hk in h)
+    for color in colors:
+        # each colour is a union of sub-lattices with starts of 1 or 2 per axis #
+        for starts in itertools.product((1, 2), repeat=u.ndim):
+            if sum(starts) % 2 != color:
+                continue
+            slices = [_color_slices(n, start) for n, start in zip(u.shape, starts)]
+            c = tuple(sl[0] for sl in slices)
+            total = -f[c]
+            for axis in range(u.ndim):
+                for neighbour in (1, 2):
+                    index = list(c)
+                    index[axis] = slices[axis][neighbour]
+                    total = total + u[tuple(index)] / h[axis]**2
+            u[c] = np.where(free[c], total / diag, u[c])
+    return u
+
+def restrict(r, coarse_free):
+    # full weighting of the fine residual, one axis at a time #
+    for axis in range(r.ndim):
+        r = np.moveaxis(r, axis, 0)
+        rc = np.zeros(((r.shape[0] + 1) // 2,) + r.shape[1:])
+        rc[1:-1] = 0.25*r[1:-3:2] + 0.5*r[2:-2:2] + 0.25*r[3:-1:2]
+        r = np.moveaxis(rc, 0, axis)
+    r[~coarse_free] = 0.0
+    return r
+
+def prolong(ec, fine_free):
+    # multilinear interpolation of the coarse correction, one axis at a time #
+    e = ec
+    for axis in range(e.ndim):
+        e = np.moveaxis(e, axis, 0)
+        fine = np.zeros((2*e.shape[0] - 1,) + e.shape[1:])
+        fine[::2] = e
+        fine[1::2] = 0.5*(e[:-1] + e[1:])
+        e = np.moveaxis(fine, 0, axis)
+    e[~fine_free] = 0.0
+    return e
+
+def mg_solver(fixed, h, levels=None, coarsest=32, pre=2, post=2):
+    '''
+    Multigrid hierarchy for a 2d or 3d grid with fixed-cell mask `fixed`
+    and uniform spacing h per axis. Returns solve(boundary, f=None,
+    method='pcg', cycle='V', tol=1e-8, maxiter=100), which solves L u = f
+    with u held at boundary on the fixed cells and returns (potential,
+    report). method is 'mg' for plain V/W cycles or 'pcg' for conjugate
+    gradients with one cycle as preconditioner; report holds the
+    iteration count, relative residual history, convergence flag and
+    wall time.
+    '''
+    shape = fixed.shape
+    ndim = len(shape)
+    h = tuple(float(hk) for hk in h)
+    if levels is None:
+        levels = _count_levels(shape, coarsest)
+    padded = tuple(_padded_size(n, levels) for n in shape)
+    inner = tuple(slice(0, n) for n in shape)
+    free = np.zeros(padded, dtype=bool)
+    free[inner] = ~fixed
+    # only the free masks are kept for each level #
+    free_masks = [free]
+    for level in range(1, levels):
+        coarse = free_masks[-1][(slice(None, None, 2),) * ndim].copy()
+        for axis in range(ndim):
+            edge = [slice(None)] * ndim
+            edge[axis] = [0, -1]
+            coarse[tuple(edge)] = False
+        free_masks.append(coarse)
+    spacings = [tuple(hk * 2**level for hk in h) for level in range(levels)]
+    # direct factorisation on the coarsest level #
+    free_c = free_masks[-1].ravel()
+    L_c = laplacian_matrix(*[np.arange(n) * hk for n, hk
+                             in zip(free_masks[-1].shape, spacings[-1])])
+    lu_c = splu(L_c[free_c][:, free_c].tocsc()) if free_c.any() else None
+
+    def coarse_solve(f):
+        e = np.zeros(f.shape)
+        if lu_c is not None:
+            e.reshape(-1)[free_c] = lu_c.solve(f.reshape(-1)[free_c])
+        return e
+
+    def mg_cycle(level, u, f, gamma):
+        free = free_masks[level]
+        h = spacings[level]
+        if level == levels - 1:
+            return u + coarse_solve(residual(u, f, free, h))
+        for n in range(pre):
+            smooth(u, f, free, h, (0, 1))
+        rc = restrict(residual(u, f, free, h), free_masks[level + 1])
+        ec = np.zeros(rc.shape)
+        for n in range(gamma):
+            ec = mg_cycle(level + 1, ec, rc, gamma)
+        u += prolong(ec, free)
+        # reverse colour order after the correction keeps the cycle symmetric #
+        for n in range(post):
+            smooth(u, f, free, h, (1, 0))
+        return u
+
+    def solve(boundary, f=None, method='pcg', cycle='V', tol=1e-8, maxiter=100):
+        start = time.time()
+        gamma = {'V': 1, 'W': 2}[cycle]
+        free = free_masks[0]
+        u = np.zeros(padded)
+        u[inner] = boundary
+        u[free] = 0.0
+        rhs = np.zeros(padded)
+        if f is not None:
+            rhs[inner] = f
+        r = residual(u, rhs, free, h)
+        r0 = np.linalg.norm(r)
+        residuals = [1.0]
+        converged = r0 == 0.0
+        iterations = 0
+        if method == 'mg':
+            while not converged and iterations < maxiter:
+                u = mg_cycle(0, u, rhs, gamma)
+                iterations += 1
+                residuals.append(np.linalg.norm(residual(u, rhs, free, h)) / r0)
+                converged = residuals[-1] < tol
+        elif method == 'pcg':
+            z = mg_cycle(0, np.zeros_like(u), r, gamma)
+            p = z.copy()
+            rz = np.vdot(r, z)
+            while not converged and iterations < maxiter:
+                Ap = apply_laplacian(p, h)
+                Ap[~free] = 0.0
+                alpha = rz / np.vdot(p, Ap)
+                u += alpha * p
+                r -= alpha * Ap
+                iterations += 1
+                residuals.append(np.linalg.norm(r) / r0)
+                converged = residuals[-1] < tol
+                if converged:
+                    break
+                z = mg_cycle(0, np.zeros_like(u), r, gamma)
+                rz_new = np.vdot(r, z)
+                p = z + (rz_new / rz) * p
+                rz = rz_new
+        else:
+            raise ValueError("unknown method %r" % method)
+        report = {'method': method, 'cycle': cycle, 'levels': levels,
+                  'iterations': iterations, 'residuals': np.array(residuals),
+                  'converged': converged, 'time': time.time() - start}
+        return u[inner].copy(), report
+
+    return solve
+
+def multigrid_solver(space, x, y, levels=None, coarsest=32, pre=2, post=2):
+    '''
+    Set up a geometric multigrid hierarchy for the conductors in space
+    (see mg_solver for the returned solve function).
+    '''
+    return mg_solver(fixed_cells(space), (grid_spacing(x), grid_spacing(y)),
+                     levels, coarsest, pre, post)
+
+def calculate_potential_multigrid(space, x, y, V=V_0, **kwargs):
+    '''
+    Potential with the conductors in space held at +/-V, from a multigrid
+    solve. Extra keyword arguments are passed to solve; returns
+    (potential, report).
+    '''
+    solve = multigrid_solver(space, x, y)
+    return solve(conductor_potential(space, V), **kwargs)
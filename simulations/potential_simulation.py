@@ -1,6 +1,7 @@
 from conductor_creation import *
 
 eps_0 = 8.85418782e-12
+from alignment_simulation import V_0
 
 import numpy as np
 import scipy.sparse as sparse
@@ -20,7 +21,7 @@ def get_Laplacian_LinearOperator(grid_shape):
     from scipy.sparse.linalg import LinearOperator
     N = np.prod(grid_shape)
     LaplacianOperator = LinearOperator(
-    (N, N), matvec=matvec, dtype=np.float)
+    (N, N), matvec=matvec, dtype=float)
     return LaplacianOperator
 
 def calculate_potential2(space, x, y):
@@ -33,6 +34,302 @@ def calculate_potential2(space, x, y):
     potential_space = vsol.reshape(space.shape)
     return potential_space
 
+def second_difference_matrix(x):
+    '''
+    1d second derivative on the (possibly non-uniform) axis x as a sparse
+    matrix. End rows are left empty as those points are held fixed.
+    '''
+    h = np.diff(x)
+    n = len(x)
+    lower = np.zeros(n); diag = np.zeros(n); upper = np.zeros(n)
+    # three point stencil 2/(h_l+h_u) * ((f_u-f)/h_u - (f-f_l)/h_l) #
+    h_l = h[:-1]; h_u = h[1:]
+    lower[1:-1] = 2.0 / (h_l * (h_l + h_u))
+    upper[1:-1] = 2.0 / (h_u * (h_l + h_u))
+    diag[1:-1] = -2.0 / (h_l * h_u)
+    return sparse.diags([lower[1:], diag, upper[:-1]], [-1, 0, 1],
+                        shape=(n, n), format='csr')
+
+def laplacian_matrix(*axes):
+    '''
+    5-point (7-point in 3d) Laplacian on the grid given by axes (x, y[, z])
+    as a CSR matrix acting on space.flatten(), i.e. space[i][j] -> row
+    i*len(y) + j.
+    '''
+    L = None
+    for n, axis in enumerate(axes):
+        # second difference along this axis, identity along the others #
+        term = second_difference_matrix(axis)
+        before = int(np.prod([len(a) for a in axes[:n]]))
+        after = int(np.prod([len(a) for a in axes[n+1:]]))
+        term = sparse.kron(sparse.identity(before), term, format='csr')
+        term = sparse.kron(term, sparse.identity(after), format='csr')
+        L = term if L is None else L + term
+    return L
+
+def fixed_cells(space):
+    # conductors and the outer edge of the grid are held at fixed potential #
+    fixed = (space != 0)
+    for axis in range(fixed.ndim):
+        edge = [slice(None)] * fixed.ndim
+        edge[axis] = [0, -1]
+        fixed[tuple(edge)] = True
+    return fixed
+
+def conductor_potential(space, V=V_0):
+    '''
+    Boundary potentials with tip 1 (space > 0) at +V and tip 2 (space < 0)
+    at -V. An array of voltages gives a stack of boundaries, one per V.
+    '''
+    V = np.asarray(V, dtype=np.float64)
+    return V.reshape(V.shape + (1,) * space.ndim) * np.sign(space)
+
+def potential_solver(space, x, y):
+    '''
+    Assemble and factorise (splu) the Dirichlet problem for the conductor
+    geometry in space once. Returns solve(boundary), where boundary is an
+    (nx,ny) array, or a (k,nx,ny) stack, of potentials on the fixed cells
+    (conductors and grid edge); all right hand sides are solved together.
+    solve(boundary, f) solves Poisson's equation lap(V) = f on the free
+    cells instead, with f of the same shape as boundary (or one (nx,ny)
+    source for every boundary).
+    '''
+    from scipy.sparse.linalg import splu
+    fixed = fixed_cells(space).ravel()
+    free = ~fixed
+    L = laplacian_matrix(x, y)
+    L_ff = L[free][:, free]
+    L_fc = L[free][:, fixed]
+    # the stencil is structurally symmetric, so order on A^T+A and keep #
+    # diagonal pivots, which roughly halves the factorisation time      #
+    lu = splu(L_ff.tocsc(), permc_spec='MMD_AT_PLUS_A',
+              options=dict(SymmetricMode=True))
+    def solve(boundary, f=None):
+        boundary = np.asarray(boundary, dtype=np.float64)
+        stack = boundary.reshape((-1, space.size))
+        # move the known conductor potentials to the right hand side #
+        b = -L_fc.dot(stack[:, fixed].T)
+        if f is not None:
+            f = np.asarray(f, dtype=np.float64).reshape((-1, space.size))
+            b = b + f[:, free].T
+        potential = stack.copy()
+        potential[:, free] = lu.solve(np.asfortranarray(b)).T
+        return potential.reshape(boundary.shape)
+    return solve
+
+def calculate_potential_sparse(space, x, y, V=V_0):
+    '''
+    Potential with the conductors in space held at +/-V (see
+    conductor_potential), from a sparse direct solve of Laplace's equation.
+    '''
+    solve = potential_solver(space, x, y)
+    return solve(conductor_potential(space, V))
+
+def grid_spacing(x):
+    # spacing of a uniformly spaced axis #
+    h = np.diff(x)
+    if not np.allclose(h, h[0], rtol=1e-6, atol=0):
+        raise ValueError("a uniformly spaced grid is needed")
+    return h[0]
+
+def coulomb_kernels(x, y):
+    '''
+    Potential and field (x, y) kernels of a unit charge over every grid
+    offset (-(nx-1)..nx-1, -(ny-1)..ny-1). The r=0 self term is set to
+    zero, matching the direct sum which never evaluates a charge on
+    itself.
+    '''
+    dx = grid_spacing(x); dy = grid_spacing(y)
+    kx = dx * np.arange(-(len(x) - 1), len(x))
+    ky = dy * np.arange(-(len(y) - 1), len(y))
+    DX = kx[:, np.newaxis]; DY = ky[np.newaxis, :]
+    r = np.hypot(DX, DY)
+    r[len(x) - 1, len(y) - 1] = np.inf
+    K = 1.0/(4*np.pi*eps_0*r)
+    Kx = DX * K / r**2
+    Ky = DY * K / r**2
+    return K, Kx, Ky
+
+def _convolve_charge(charge_space, kernel):
+    # linear (zero padded) FFT convolution cropped back to the grid #
+    from scipy.signal import fftconvolve
+    nx, ny = charge_space.shape
+    full = fftconvolve(np.asarray(charge_space, dtype=np.float64), kernel, mode='full')
+    return full[nx-1:2*nx-1, ny-1:2*ny-1]
+
+def conductor_interior(space):
+    # cells skipped by the direct sums #
+    return (space == 1) | (space == 2)
+
+def calculate_potential_fft(space, x, y, charge_space):
+    '''
+    FFT convolution version of calculate_potential, treating charge_space
+    as the source image on a uniform grid. Agrees with the direct sum to
+    within 1e-12 of the largest potential (FFT round off, ~1e-15 on the
+    default tip space); cells inside the conductor, as skipped by
+    calculate_potential, are zero.
+    '''
+    K, Kx, Ky = coulomb_kernels(x, y)
+    potential_space = _convolve_charge(charge_space, K)
+    potential_space[conductor_interior(space)] = 0.0
+    return potential_space
+
+def calculate_field_fft(space, x, y, charge_space, summed_magnitude=False):
+    '''
+    FFT convolution field from the charges in charge_space, returning the
+    components (Ex, Ey) of the total field with conductor cells zeroed.
+    With summed_magnitude=True it instead returns the sum of the field
+    magnitudes of each charge, which is what calculate_field computes.
+    Same tolerance as calculate_potential_fft.
+    '''
+    K, Kx, Ky = coulomb_kernels(x, y)
+    interior = conductor_interior(space)
+    if summed_magnitude:
+        # |E| of one charge is |q|/(4 pi eps_0 r^2) #
+        field_space = _convolve_charge(np.abs(charge_space), np.hypot(Kx, Ky))
+        field_space[interior] = 0.0
+        return field_space
+    Ex = _convolve_charge(charge_space, Kx)
+    Ey = _convolve_charge(charge_space, Ky)
+    Ex[interior] = 0.0; Ey[interior] = 0.0
+    return Ex, Ey
+
+def direct_sum(points, sources, charges, memory=64*2**20, threads=None):
+    '''
+    Exact pairwise Coulomb sum at observation points (n,2) from point
+    charges at sources (m,2). Returns the potential, Ex, Ey and |E| at each
+    point. Points are handled in blocks sized so the (block, m) temporaries
+    stay within `memory` bytes, and blocks are spread over a pool of
+    `threads` threads (numpy releases the GIL for the array work).
+    Coincident pairs (r=0) are left out, as in calculate_potential.
+    '''
+    from multiprocessing.pool import ThreadPool
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    sources = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+    charges = np.asarray(charges, dtype=np.float64).ravel()
+    n = points.shape[0]; m = sources.shape[0]
+    result = np.zeros((4, n))
+    if n == 0 or m == 0:
+        return result[0], result[1], result[2], result[3]
+    # about six (block, m) float64 temporaries are live at once #
+    block = int(max(1, min(n, memory // (6 * 8 * m))))
+    q = charges / (4*np.pi*eps_0)
+    def evaluate(start):
+        stop = min(start + block, n)
+        dx = points[start:stop, 0, np.newaxis] - sources[np.newaxis, :, 0]
+        dy = points[start:stop, 1, np.newaxis] - sources[np.newaxis, :, 1]
+        r = np.hypot(dx, dy)
+        r[r == 0] = np.inf
+        V = q / r
+        result[0, start:stop] = V.sum(axis=1)
+        V /= r**2
+        result[1, start:stop] = (V * dx).sum(axis=1)
+        result[2, start:stop] = (V * dy).sum(axis=1)
+    starts = range(0, n, block)
+    if threads == 1 or len(starts) == 1:
+        for start in starts:
+            evaluate(start)
+    else:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(evaluate, starts)
+        finally:
+            pool.close()
+            pool.join()
+    result[3] = np.hypot(result[1], result[2])
+    return result[0], result[1], result[2], result[3]
+
+def calculate_fields_direct(space, x, y, surfaces, memory=64*2**20, threads=None):
+    '''
+    Reference direct sum over every grid cell from the charges in surfaces
+    (legacy or compact), skipping the conductor cells the same way as
+    calculate_potential. Returns potential, Ex, Ey and |E| grids.
+    '''
+    sources = np.concatenate([surface_coordinates(surface, x, y) for surface in surfaces])
+    charge = np.concatenate([split_surface(surface)[1] for surface in surfaces])
+    outside = ~conductor_interior(space)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    points = np.column_stack((X[outside], Y[outside]))
+    fields = direct_sum(points, sources, charge, memory, threads)
+    grids = []
+    for values in fields:
+        grid = np.zeros(space.shape)
+        grid[outside] = values
+        grids.append(grid)
+    return tuple(grids)
+
+def conductor_charges(potential, space, x, y, depth=1.0):
+    '''
+    Charge on tip 1 (space > 0) and tip 2 (space < 0) from Gauss's law:
+    the discrete Laplacian summed over a conductor's cells is the flux of
+    grad V out of it. Charges are per unit depth times depth.
+    '''
+    Lu = laplacian_matrix(x, y).dot(potential.reshape(-1, space.size).T).T
+    Lu = Lu.reshape(potential.shape)
+    cell = grid_spacing(x) * grid_spacing(y)
+    q = -eps_0 * depth * cell
+    return q * Lu[..., space > 0].sum(axis=-1), q * Lu[..., space < 0].sum(axis=-1)
+
+def capacitance_matrix(space, x, y, depth=1.0, solve=None):
+    '''
+    2x2 capacitance matrix of the two tips with the grid edge grounded:
+    C[i, j] is the charge on tip i with tip j at 1 V and the other at 0 V.
+    Both cases are solved together from one factorisation (pass a solve
+    from potential_solver to reuse one).
+    '''
+    if solve is None:
+        solve = potential_solver(space, x, y)
+    boundary = np.array([(space > 0), (space < 0)], dtype=np.float64)
+    q1, q2 = conductor_charges(solve(boundary), space, x, y, depth)
+    return np.array([q1, q2])
+
+def capacitance_sweep(x_offsets, d0=1e-6, theta1=np.radians(30), theta2=np.radians(15),
+                      nx=50, ny=50, depth=None, cached=False):
+    '''
+    Capacitance matrices C (n,2,2) and dC/dx_offset over a set of offsets.
+    Offsets whose rasterised tips are the same form one family, which is
+    factorised once and solved in one call. With cached=True offsets are
+    rounded to whole grid cells (see cached_tip_space), so offsets within
+    a cell share a family. dC/dx comes from central differences between
+    the families of the same batch. depth defaults to one grid cell, as in
+    tip_forces. Also returns the mutual capacitance -C[:, 0, 1] and its
+    derivative and the number of factorisations.
+    '''
+    x_offsets = np.asarray(x_offsets, dtype=np.float64).ravel()
+    x, y = create_tip_grid(nx, ny)
+    if depth is None:
+        depth = grid_spacing(x)
+    if cached:
+        tip_space = cached_tip_space(d0, theta1, theta2, np.abs(x_offsets).max(),
+                                     nx, ny, compact=True)
+        dx = grid_spacing(x)
+        offsets = np.round(x_offsets / dx) * dx
+    else:
+        tip_space = lambda x_offset: create_tip_space(d0, theta1, theta2, x_offset,
+                                                      nx, ny, compact=True)
+        offsets = x_offsets
+    families = {}
+    for n, x_offset in enumerate(x_offsets):
+        space = tip_space(x_offset)[2]
+        families.setdefault(space.tobytes(), (space, []))[1].append(n)
+    # one capacitance matrix and offset per family, in offset order #
+    members = [m for space, m in families.values()]
+    family_C = np.array([capacitance_matrix(space, x, y, depth)
+                         for space, m in families.values()])
+    family_x = np.array([offsets[m].mean() for m in members])
+    order = np.argsort(family_x)
+    family_C = family_C[order]; family_x = family_x[order]
+    members = [members[n] for n in order]
+    if len(family_x) > 1:
+        family_dC = np.gradient(family_C, family_x, axis=0)
+    else:
+        family_dC = np.zeros_like(family_C)
+    C = np.empty((len(x_offsets), 2, 2)); dC = np.empty((len(x_offsets), 2, 2))
+    for n, m in enumerate(members):
+        C[m] = family_C[n]; dC[m] = family_dC[n]
+    return {'C': C, 'dC_dx': dC, 'mutual': -C[:, 0, 1], 'dmutual_dx': -dC[:, 0, 1],
+            'factorisations': len(families)}
+
 def calculate_potential(space, x, y, surfaces):
     potential = lambda q, r: q/(4*np.pi*eps_0*r)
     potential_space = np.zeros_like(space)
@@ -75,9 +372,9 @@ if __name__ == '__main__':
     theta2 = np.radians(15)
     x, y, space, charge_space, surfaces =\
        create_tip_space(d0, theta1, theta2, x_offset)
-    print "created space"
+    print("created space")
     potential_space = calculate_potential2(space, x, y)
-    print "calculated potential"
+    print("calculated potential")
     #field_space = calculate_field(space, x, y, surfaces)
     #print "calculated field"
 
@@ -93,7 +390,7 @@ if __name__ == '__main__':
     ax = fig.add_subplot(121)
     cfax = ax.contourf(X, Y, Z, c_levels,
                         norm=norm,
-                        alpha=1.0, cmap=cm.get_cmap(cmap, len(c_levels)-1))
+                        alpha=1.0, cmap=cmap)
     cb = plt.colorbar(cfax)
     formatter = plt.ScalarFormatter(useOffset=False, useMathText=True)
     formatter.set_scientific(True) 
@@ -112,7 +409,7 @@ if __name__ == '__main__':
     ax = fig.add_subplot(122)
     cfax = ax.contourf(X, Y, Z, c_levels,
                         norm=norm,
-                        alpha=1.0, cmap=cm.get_cmap(cmap, len(c_levels)-1))
+                        alpha=1.0, cmap=cmap)
     cb = plt.colorbar(cfax)
     formatter = plt.ScalarFormatter(useOffset=False, useMathText=True)
     formatter.set_scientific(True) 
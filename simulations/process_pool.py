@@ -0,0 +1,19 @@
+import multiprocessing
+
+# Process pools for sweeps #
+
+def pool_map(func, tasks, processes=None, chunksize=None):
+    '''
+    list(map(func, tasks)) spread over a pool of `processes` worker
+    processes (all cores by default). With processes=1, or a single task,
+    it runs in-process. func must be module level so it can be pickled.
+    '''
+    tasks = list(tasks)
+    if processes == 1 or len(tasks) <= 1:
+        return list(map(func, tasks))
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(func, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,158 @@
+import time
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spilu
+from potential_simulation import V_0, laplacian_matrix, fixed_cells, conductor_potential
+from conductor_creation import create_tip_space
+
+# Warm started iterative solves over a sequence of tip spaces #
+#
+# Every step solves Laplace's equation with the conductors and grid edge
+# held fixed. The unknown is the correction w to the boundary potential g
+# (zero on the fixed cells), which satisfies A w = D L g with
+# A = D (-L) D + c (I - D), D the diagonal free-cell mask and c the
+# diagonal of -L. A always has the full grid size and is symmetric
+# positive definite, so the previous step's potential is a valid starting
+# point and a preconditioner built for an earlier mask can still be
+# applied when the mask moves a little; with the fixed rows on the same
+# scale as the Laplacian, cells that have changed since are only badly
+# preconditioned, not out by a factor of 1/h^2.
+
+def _masked_operator(L, free):
+    D = sparse.diags(free.astype(np.float64))
+    # the grid edge rows of L are empty, so take the interior diagonal #
+    scale = -L.diagonal().min()
+    return (D.dot(-L).dot(D) + sparse.diags(scale * (~free))).tocsc()
+
+def _pcg(A, b, w, M, tol, maxiter):
+    # preconditioned conjugate gradients from w, returns (w, iterations, residual) #
+    r = b - A.dot(w)
+    b_norm = np.linalg.norm(b) or 1.0
+    residual = np.linalg.norm(r) / b_norm
+    iterations = 0
+    if residual <= tol:
+        return w, iterations, residual
+    z = M(r)
+    p = z.copy()
+    rz = np.dot(r, z)
+    while iterations < maxiter:
+        Ap = A.dot(p)
+        alpha = rz / np.dot(p, Ap)
+        w += alpha * p
+        r -= alpha * Ap
+        iterations += 1
+        residual = np.linalg.norm(r) / b_norm
+        if residual <= tol:
+            break
+        z = M(r)
+        rz_new = np.dot(r, z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    return w, iterations, residual
+
+class solver_session:
+    def __init__(self, x, y, precondition='ilu', rebuild=0.0, reuse_factor=3,
+                 tol=1e-8, maxiter=2000, drop_tol=1e-4, fill_factor=10, warm=True):
+        '''
+        Iterative potential solves on the grid x, y that carry state from
+        one step to the next. precondition is 'ilu' (spilu, cached) or
+        'jacobi'. The ILU is rebuilt when more than a fraction `rebuild`
+        of the cells have changed between fixed and free since it was
+        built (by default whenever the mask changes), or when a solve
+        with the old ILU takes more than reuse_factor times the
+        iterations of the last fresh one (the solve then carries on with
+        the new ILU). With warm=True each solve starts from the previous
+        potential. Every step's report is kept in history.
+
+        The old ILU only pays off while few cells have changed: repeated
+        solves on one mask (e.g. over voltages) or offset steps of under
+        a cell. An offset step of a cell or more changes every cell along
+        the tip 1 surface, and refactorising is then cheaper than the
+        extra iterations, so offset sweeps rebuild at every step.
+        '''
+        self.x = x; self.y = y
+        self.L = laplacian_matrix(x, y).tocsr()
+        self.precondition = precondition
+        self.rebuild = rebuild
+        self.reuse_factor = reuse_factor
+        self.tol = tol; self.maxiter = maxiter
+        self.drop_tol = drop_tol; self.fill_factor = fill_factor
+        self.warm = warm
+        self.x0 = None
+        self.ilu = None
+        self.ilu_fixed = None
+        self.ilu_iterations = None
+        self.history = []
+
+    def _build_ilu(self, A, fixed):
+        # symmetric ordering and diagonal pivots keep the ILU close to #
+        # symmetric, which conjugate gradients needs                   #
+        self.ilu = spilu(A, drop_tol=self.drop_tol, fill_factor=self.fill_factor,
+                         permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0,
+                         options=dict(SymmetricMode=True))
+        self.ilu_fixed = fixed
+        return self.ilu.solve
+
+    def step(self, space, V=V_0):
+        '''
+        Potential for the conductors in space held at +/-V, by
+        preconditioned conjugate gradients. Returns (potential, report)
+        with the iteration count, final relative residual, whether the
+        preconditioner was rebuilt, convergence flag and wall time.
+        '''
+        start = time.time()
+        fixed = fixed_cells(space).ravel()
+        free = ~fixed
+        g = conductor_potential(space, V).ravel()
+        A = _masked_operator(self.L, free)
+        b = free * self.L.dot(g)
+        w = np.zeros(len(g))
+        if self.warm and self.x0 is not None:
+            w[free] = self.x0[free]
+        if self.precondition == 'jacobi':
+            inverse = 1.0 / A.diagonal()
+            w, iterations, residual = _pcg(A, b, w, lambda r: inverse * r,
+                                           self.tol, self.maxiter)
+            rebuilt = False
+        elif self.precondition == 'ilu':
+            rebuilt = bool(self.ilu is None or
+                           np.mean(fixed != self.ilu_fixed) > self.rebuild)
+            iterations = 0
+            if not rebuilt:
+                limit = min(self.maxiter, self.reuse_factor * self.ilu_iterations + 5)
+                w, iterations, residual = _pcg(A, b, w, self.ilu.solve, self.tol, limit)
+                # if the old ILU no longer fits the mask, carry on with a new one #
+                rebuilt = bool(residual > self.tol)
+            if rebuilt:
+                w, fresh, residual = _pcg(A, b, w, self._build_ilu(A, fixed),
+                                          self.tol, self.maxiter - iterations)
+                iterations += fresh
+                self.ilu_iterations = fresh
+        else:
+            raise ValueError("unknown preconditioner %r" % self.precondition)
+        potential = np.where(free, w, g)
+        self.x0 = potential
+        report = {'iterations': iterations, 'residual': residual, 'rebuilt': rebuilt,
+                  'converged': residual <= self.tol, 'time': time.time() - start}
+        self.history.append(report)
+        return potential.reshape(space.shape), report
+
+def sweep_potentials(x_offsets, d0=500e-9, theta1=np.radians(30), theta2=np.radians(15),
+                     nx=50, ny=50, V=V_0, **kwargs):
+    '''
+    Potentials over an x_offset sweep from one solver session (keyword
+    arguments go to solver_session). Returns the (n, nx, ny) potentials
+    and the per-step reports. The ILU is rebuilt at every step unless
+    the offsets are under a cell apart (see solver_session).
+    '''
+    if len(x_offsets) == 0:
+        return np.zeros((0, nx, ny)), []
+    session = None
+    potentials = []
+    for x_offset in x_offsets:
+        x, y, space, charge_space, surfaces = create_tip_space(d0, theta1, theta2, x_offset,
+                                                               nx, ny, compact=True)
+        if session is None:
+            session = solver_session(x, y, **kwargs)
+        potentials.append(session.step(space, V)[0])
+    return np.array(potentials), session.history
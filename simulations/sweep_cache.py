@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+import tempfile
+import itertools
+import numpy as np
+from conductor_creation import create_tip_space
+from alignment_simulation import space_response, V_0, k_0
+from potential_simulation import calculate_potential_sparse
+from process_pool import pool_map
+from tip_space_3d import alignment_response_3d
+
+# Parameter sweeps with an on-disk result cache #
+#
+# Every parameter point is hashed together with the grid settings and a
+# model version, and its result is kept in cache_dir as <hash>.npz. A
+# sweep only runs the points that have no file yet, and each worker
+# writes its own file as soon as the point is done, so a sweep that
+# stopped part way picks up where it left off when run again. Bump
+# MODEL_VERSION whenever a change to the model alters results. 3d points
+# (run_sweep_3d) also take z_offset and are keyed on the 3d grid and tip
+# shape, so both kinds can share a cache_dir.
+
+MODEL_VERSION = 1
+PARAMETERS = ('d0', 'theta1', 'theta2', 'V_0', 'k_0', 'x_offset')
+PARAMETERS_3D = PARAMETERS + ('z_offset',)
+DEFAULTS = {'d0': 500e-9, 'theta1': np.radians(30), 'theta2': np.radians(15),
+            'V_0': V_0, 'k_0': k_0, 'x_offset': 0.0, 'z_offset': 0.0}
+
+def point_key(point, nx, ny, names=PARAMETERS, **grid):
+    '''
+    Hex digest identifying one parameter point (a dict of `names`) at the
+    given grid size, plus any other grid settings in grid. Floats go
+    through repr so the key is exact.
+    '''
+    settings = dict((name, repr(float(point[name]))) for name in names)
+    settings.update(grid)
+    settings.update({'nx': int(nx), 'ny': int(ny), 'version': MODEL_VERSION})
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+def cache_file(cache_dir, key):
+    return os.path.join(cache_dir, key + '.npz')
+
+def _write_atomic(fname, **arrays):
+    # write to a temporary file then rename, so a crash never leaves half a file #
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(fname))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        # replaces any older file, e.g. one cached without the fields #
+        os.replace(tmp, fname)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def load_point(cache_dir, key):
+    '''
+    Cached result for a key as a dict (amplitude, phase, params and, if
+    stored, the fields), or None if the point has not been run.
+    '''
+    fname = cache_file(cache_dir, key)
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname) as data:
+        result = dict((name, data[name]) for name in data.files)
+    result['params'] = json.loads(str(result['params']))
+    return result
+
+def _run_point(args):
+    # compute and cache one point #
+    cache_dir, key, point, nx, ny, store_fields = args
+    x, y, space, charge_space, surfaces = create_tip_space(
+        point['d0'], point['theta1'], point['theta2'], point['x_offset'], nx, ny, compact=True)
+    amplitude, phase = space_response(x, y, space, charge_space, surfaces,
+                                      V=point['V_0'], k=point['k_0'])
+    arrays = {'amplitude': amplitude, 'phase': phase,
+              'params': json.dumps(point, sort_keys=True)}
+    if store_fields:
+        # tips at +/-V_0/2, so the gap sees V_0 as in calculate_contribution #
+        potential = calculate_potential_sparse(space, x, y, point['V_0'] / 2.0)
+        gx, gy = np.gradient(potential, x, y)
+        arrays.update({'charge_space': charge_space, 'potential': potential,
+                       'Ex': -gx, 'Ey': -gy})
+    _write_atomic(cache_file(cache_dir, key), **arrays)
+    return key, amplitude, phase
+
+def _run_point_3d(args):
+    # compute and cache one point of the 3d tip space #
+    cache_dir, key, point, n, shape = args
+    amplitude, phase = alignment_response_3d(
+        point['d0'], point['theta1'], point['theta2'], point['x_offset'], n, shape,
+        point['z_offset'], V=point['V_0'], k=point['k_0'])
+    _write_atomic(cache_file(cache_dir, key), amplitude=amplitude, phase=phase,
+                  params=json.dumps(point, sort_keys=True))
+    return key, amplitude, phase
+
+def _cached_sweep(cache_dir, names, params, key_of, worker, task, processes,
+                  complete=None):
+    '''
+    Shared body of the sweeps: key_of(point) names a point's cache file,
+    task(key, point) is what worker is mapped over for a missing point
+    and complete, if set, tells whether a cached result is enough.
+    '''
+    unknown = set(params) - set(names)
+    if unknown:
+        raise ValueError("unknown sweep parameters %s" % ', '.join(sorted(unknown)))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    values = [np.asarray(params.get(name, DEFAULTS[name]), dtype=np.float64)
+              for name in names]
+    shape = sum((v.shape for v in values), ())
+    points = [dict(zip(names, map(float, p)))
+              for p in itertools.product(*[v.ravel() for v in values])]
+    keys = [key_of(point) for point in points]
+    amplitude = np.empty(len(points))
+    phase = np.empty(len(points))
+    pending = {}
+    for n, key in enumerate(keys):
+        result = load_point(cache_dir, key)
+        if result is not None and (complete is None or complete(result)):
+            amplitude[n] = result['amplitude']
+            phase[n] = result['phase']
+        else:
+            # identical points in one sweep are only run once #
+            pending.setdefault(key, []).append(n)
+    tasks = [task(key, points[index[0]]) for key, index in pending.items()]
+    for key, point_amplitude, point_phase in pool_map(worker, tasks, processes):
+        amplitude[pending[key]] = point_amplitude
+        phase[pending[key]] = point_phase
+    return {'amplitude': amplitude.reshape(shape), 'phase': phase.reshape(shape),
+            'keys': np.array(keys).reshape(shape), 'computed': len(tasks),
+            'cached': len(points) - sum(len(index) for index in pending.values())}
+
+def run_sweep(cache_dir, nx=50, ny=50, processes=None, store_fields=False, **params):
+    '''
+    Amplitude and phase over every combination of the parameters in
+    PARAMETERS, given as keyword scalars or arrays (missing ones take
+    DEFAULTS). The returned arrays have the shapes of the parameters
+    joined in PARAMETERS order. Points already in cache_dir are read
+    back; the rest are run on `processes` workers (see pool_map) and cached,
+    with the fields too if store_fields is set: the potential (tips at
+    +/-V_0/2), the field Ex, Ey and the charge_space. Returns a dict with
+    amplitude, phase, the cache keys and the number of points computed
+    and read from the cache.
+    '''
+    key_of = lambda point: point_key(point, nx, ny)
+    task = lambda key, point: (cache_dir, key, point, nx, ny, store_fields)
+    complete = (lambda result: 'potential' in result) if store_fields else None
+    return _cached_sweep(cache_dir, PARAMETERS, params, key_of, _run_point, task,
+                         processes, complete)
+
+def run_sweep_3d(cache_dir, n=64, shape='pyramid', processes=None, **params):
+    '''
+    run_sweep for the 3d tips of tip_space_3d on an n^3 grid, over the
+    parameters in PARAMETERS_3D (PARAMETERS and z_offset).
+    '''
+    key_of = lambda point: point_key(point, n, n, PARAMETERS_3D, nz=int(n), shape=shape)
+    task = lambda key, point: (cache_dir, key, point, n, shape)
+    return _cached_sweep(cache_dir, PARAMETERS_3D, params, key_of, _run_point_3d, task,
+                         processes)
+
+def clear_cache(cache_dir):
+    # remove every cached point and any temporary file left by a crash #
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            os.remove(os.path.join(cache_dir, name))
+            removed += 1
+    return removed
@@ -1,19 +1,18 @@
 # modules #
-import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib import rc
+from potential_simulation import direct_sum
 
-# MAIN PROGRAM #
-
-# create grid space and dimension scaling #
-nx = 20; ny = 20; nz = 100
-#space = np.zeros((nx,ny,nz))
-x = np.linspace(-10, 10, nx)
-y = np.linspace(-5, 5, ny)
-z = np.linspace(-5, 5, nz)
-space_2d = np.zeros((nx,ny))            # 2d space used for quick planar sims
+# Plate and tip potential engine #
+#
+# Tips and plates are each given by two boundary functions per object:
+# tip 1 is where both of its boundaries are <= 0, tip 2 where both of its
+# are >= 0. Surfaces are the grid points within tol of one boundary on
+# the inside of the other. The potential outside the conductors is the
+# direct Coulomb sum of unit charges on the surfaces (+ on tip 1, - on
+# tip 2), with V0 and -V0 inside the conductors.
 
 # define objects #
 d0 = 2.0
@@ -23,6 +22,12 @@ theta2 = theta1#np.radians(10)
 # define alignment parameters #
 V0 = 10
 
+def create_grid(nx=200, ny=200):
+    # grid space and dimension scaling #
+    x = np.linspace(-10, 10, nx)
+    y = np.linspace(-5, 5, ny)
+    return x, y
+
 ## define tips as being a 2d triangle for now ##
 def create_tips(d0, theta1, theta2):
     # tip 1 boundary #
@@ -43,108 +48,115 @@ def create_plates(d0):
     t2b2 = lambda x,y: x - 5 - d0/2
     return t1b1, t1b2, t2b1, t2b2
 
-# add objects to space #
-#t1b1, t1b2, t2b1, t2b2 = create_tips(d0, theta1, theta2)
-t1b1, t1b2, t2b1, t2b2 = create_plates(d0)
-
-# get tip surface coordinates #
-s1x = np.array([])
-s1y = np.array([])
-s2x = np.array([])
-s2y = np.array([])
-for i in range(len(x)):
-    for j in range(len(y)):
-        # tip 1 #
-        if (abs(t1b1(x[i],y[j])) <= 0.1 and t1b2(x[i],y[j]) <= 0)\
-           or (abs(t1b2(x[i],y[j])) <= 0.1 and t1b1(x[i],y[j]) <= 0):
-            s1x = np.append(s1x, x[i])
-            s1y = np.append(s1y, y[j])
-        # tip 2 #
-        elif (abs(t2b1(x[i],y[j])) <= 0.1 and t2b2(x[i],y[j]) >= 0)\
-             or (abs(t2b2(x[i],y[j])) <= 0.1 and t2b1(x[i],y[j]) >= 0):
-            s2x = np.append(s2x, x[i])
-            s2y = np.append(s2y, y[j])
-#print s1x
-#print s1y
-#print s2x
-#print s2y
-
-e0 = 8.85418782e-12
-potential= lambda q, r: q/(4*np.pi*e0*r)
-
-# calculate system potential #
-k=0.0
-for i in range(len(x)):
-    for j in range(len(y)):
-        k+=1
-        sys.stdout.write('\r'+str(100*k/(len(x)*len(y))))
-        sys.stdout.flush()
-        # V = V0 inside conductors #
-        ## tip 1 ##
-        if t1b1(x[i],y[j]) <= 0 and t1b2(x[i],y[j]) <= 0:
-            space_2d[i][j] = V0
-        ## tip 2 ##
-        elif t2b1(x[i],y[j]) >= 0 and t2b2(x[i],y[j]) >= 0:
-            space_2d[i][j] = -V0
-        # calculate potential outside conductors #
-        else:
-            V = 0
-            # loop over tip surfaces #
-            for ii in range(len(s1x)):
-                dx = x[i] - s1x[ii]
-                dy = y[j] - s1y[ii]
-                dr = np.sqrt(dx**2 + dy**2)
-                if dr == 0:
-                    continue
-                else:
-                    V += potential(1.0, dr)
-            for jj in range(len(s2x)):
-                dx = x[i] - s2x[jj]
-                dy = y[j] - s2y[jj]
-                dr = np.sqrt(dx**2 + dy**2)
-                if dr == 0:
-                    continue
-                else:
-                    V += potential(-1.0, dr)
-            space_2d[i][j] = V
-Ex, Ey = np.gradient(space_2d)
-field_2d = np.sqrt(Ex**2 + Ey**2)
-
-#print space_2d
-
-# plot #
-#print x.shape, y.shape, z.shape
-X, Y = np.meshgrid(x, y)
-Z = space_2d.T
-#print X.shape, Y.shape, Z.shape
-c_levels = np.linspace(Z.min(), 1.05*Z.max(), 100)
-l_levels = np.linspace(Z.min(), 1.05*Z.max(), 10)
-cmap = cm.Spectral_r
-norm = cm.colors.Normalize(vmax=Z.max(), vmin=Z.min())
-lw = 0.5
-
-fig = plt.figure(figsize=(15, 5))
-ax = fig.add_subplot(131)
-#ax.plot(s1x, s1y, 'r.')
-#ax.plot(s2x, s2y, 'b.')
-cfax = ax.contourf(X, Y, Z, c_levels,
-                    norm=norm,
-                    alpha=1.0, cmap=cm.get_cmap(cmap, len(c_levels)-1))
-cb = plt.colorbar(cfax, shrink=1.0, extend='both')
-
-Z = field_2d.T
-c_levels = np.linspace(Z.min(), 1.05*Z.max(), 100)
-l_levels = np.linspace(Z.min(), 1.05*Z.max(), 10)
-cmap = cm.Spectral_r
-norm = cm.colors.Normalize(vmax=Z.max(), vmin=Z.min())
-ax = fig.add_subplot(132)
-cfax = ax.contourf(X, Y, Z, c_levels,
-                    norm=norm,
-                    alpha=1.0, cmap=cm.get_cmap(cmap, len(c_levels)-1))
-cb = plt.colorbar(cfax, shrink=1.0, extend='both')
-
-ax = fig.add_subplot(133)
-ax.quiver(X, Y, Ex, Ey)
-plt.tight_layout()
-plt.savefig('C:\\users\\alan\\desktop\\tips.png', bbox_inches=0)
-plt.show()
+def evaluate_boundaries(boundaries, x, y):
+    # every boundary function on the whole grid, indexed [i, j] #
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    return [b(X, Y) * np.ones(X.shape) for b in boundaries]
+
+def conductor_masks(boundaries, x, y):
+    # grid points inside tip 1 and inside tip 2 #
+    t1b1, t1b2, t2b1, t2b2 = evaluate_boundaries(boundaries, x, y)
+    return (t1b1 <= 0) & (t1b2 <= 0), (t2b1 >= 0) & (t2b2 >= 0)
+
+def surface_points(boundaries, x, y, tol=None):
+    '''
+    Surface coordinates (n,2) of tip 1 and tip 2: grid points within tol
+    of one boundary and inside the other. tol defaults to the larger grid
+    spacing, so every grid row crossing a boundary has a surface point
+    whatever the grid size.
+    '''
+    if tol is None:
+        tol = max(x[1] - x[0], y[1] - y[0])
+    t1b1, t1b2, t2b1, t2b2 = evaluate_boundaries(boundaries, x, y)
+    s1 = ((np.abs(t1b1) <= tol) & (t1b2 <= 0)) | ((np.abs(t1b2) <= tol) & (t1b1 <= 0))
+    s2 = ((np.abs(t2b1) <= tol) & (t2b2 >= 0)) | ((np.abs(t2b2) <= tol) & (t2b1 >= 0))
+    # a point is only on tip 2 if it is not already on tip 1 #
+    s2 &= ~s1
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    return np.column_stack((X[s1], Y[s1])), np.column_stack((X[s2], Y[s2]))
+
+def calculate_potential(boundaries, x, y, V0=V0, tol=None):
+    '''
+    Potential on the grid: V0 in tip 1, -V0 in tip 2 and the direct sum
+    of the surface charges everywhere else.
+    '''
+    inside1, inside2 = conductor_masks(boundaries, x, y)
+    s1, s2 = surface_points(boundaries, x, y, tol)
+    sources = np.concatenate((s1, s2))
+    charges = np.concatenate((np.ones(len(s1)), -np.ones(len(s2))))
+    outside = ~inside1 & ~inside2
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    space_2d = np.zeros(X.shape)
+    space_2d[inside1] = V0
+    space_2d[inside2] = -V0
+    space_2d[outside] = direct_sum(np.column_stack((X[outside], Y[outside])),
+                                   sources, charges)[0]
+    return space_2d
+
+def calculate_field(space_2d, x, y):
+    # E = -grad V with the real grid spacing, and its magnitude #
+    gx, gy = np.gradient(space_2d, x, y)
+    Ex = -gx; Ey = -gy
+    return Ex, Ey, np.sqrt(Ex**2 + Ey**2)
+
+def simulate(geometry='plates', nx=200, ny=200, d0=d0, theta1=theta1, theta2=theta2,
+             V0=V0, tol=None):
+    '''
+    Potential and field for plates or triangular tips. Returns x, y, the
+    potential and Ex, Ey and |E|, all indexed [i, j].
+    '''
+    x, y = create_grid(nx, ny)
+    if geometry == 'plates':
+        boundaries = create_plates(d0)
+    elif geometry == 'tips':
+        boundaries = create_tips(d0, theta1, theta2)
+    else:
+        raise ValueError("unknown geometry %r" % geometry)
+    space_2d = calculate_potential(boundaries, x, y, V0, tol)
+    Ex, Ey, field_2d = calculate_field(space_2d, x, y)
+    return x, y, space_2d, Ex, Ey, field_2d
+
+def plot_simulation(x, y, space_2d, Ex, Ey, field_2d, fname=None):
+    # plot #
+    #print x.shape, y.shape, z.shape
+    X, Y = np.meshgrid(x, y)
+    Z = space_2d.T
+    #print X.shape, Y.shape, Z.shape
+    c_levels = np.linspace(Z.min(), 1.05*Z.max(), 100)
+    l_levels = np.linspace(Z.min(), 1.05*Z.max(), 10)
+    cmap = cm.Spectral_r
+    norm = cm.colors.Normalize(vmax=Z.max(), vmin=Z.min())
+    lw = 0.5
+
+    fig = plt.figure(figsize=(15, 5))
+    ax = fig.add_subplot(131)
+    #ax.plot(s1x, s1y, 'r.')
+    #ax.plot(s2x, s2y, 'b.')
+    cfax = ax.contourf(X, Y, Z, c_levels,
+                        norm=norm,
+                        alpha=1.0, cmap=cmap)
+    cb = plt.colorbar(cfax, shrink=1.0, extend='both')
+
+    Z = field_2d.T
+    c_levels = np.linspace(Z.min(), 1.05*Z.max(), 100)
+    l_levels = np.linspace(Z.min(), 1.05*Z.max(), 10)
+    cmap = cm.Spectral_r
+    norm = cm.colors.Normalize(vmax=Z.max(), vmin=Z.min())
+    ax = fig.add_subplot(132)
+    cfax = ax.contourf(X, Y, Z, c_levels,
+                        norm=norm,
+                        alpha=1.0, cmap=cmap)
+    cb = plt.colorbar(cfax, shrink=1.0, extend='both')
+
+    ax = fig.add_subplot(133)
+    ax.quiver(X, Y, Ex.T, Ey.T)
+    plt.tight_layout()
+    if fname is not None:
+        plt.savefig(fname, bbox_inches=0)
+    return fig
+
+if __name__ == '__main__':
+    #x, y, space_2d, Ex, Ey, field_2d = simulate('tips')
+    x, y, space_2d, Ex, Ey, field_2d = simulate('plates')
+    plot_simulation(x, y, space_2d, Ex, Ey, field_2d, 'C:\\users\\alan\\desktop\\tips.png')
+    plt.show()
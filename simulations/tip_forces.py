@@ -0,0 +1,98 @@
+import numpy as np
+from conductor_creation import create_tip_space, create_tip_grid
+from potential_simulation import eps_0, V_0, grid_spacing, potential_solver, conductor_potential
+import alignment_simulation
+
+# Electrostatic force and force gradient on tip 1 #
+#
+# The force on a conductor is the Maxwell stress eps_0/2 |E|^2 pulling
+# outwards on its surface. On the grid the surface is the set of cell
+# faces between a conductor cell and a free cell; the field across each
+# face is the potential step over the cell spacing, normal to the face.
+# Tips are held at +V/2 and -V/2 so the tip to tip voltage is V, as in
+# calculate_contribution, and forces are per unit depth times `depth`.
+# The force gradient along the gap comes from central differences in d0,
+# which moves each tip by delta/2.
+
+def surface_faces(mask, free):
+    '''
+    Faces between cells of mask and free cells, as (i, j, axis, sign)
+    arrays: cell (i, j) of the conductor, the axis crossed and the
+    direction (+1/-1) of the outward normal.
+    '''
+    faces = []
+    for axis in range(2):
+        for sign in (1, -1):
+            neighbour = np.roll(free, -sign, axis=axis)
+            # cells on the grid edge have no neighbour across it #
+            edge = [slice(None), slice(None)]
+            edge[axis] = -1 if sign == 1 else 0
+            neighbour[tuple(edge)] = False
+            i, j = np.nonzero(mask & neighbour)
+            faces.append((i, j, np.full(len(i), axis), np.full(len(i), sign)))
+    return tuple(np.concatenate(a) for a in zip(*faces))
+
+def maxwell_force(potential, mask, free, x, y, depth):
+    # (Fx, Fy) on the conductor cells in mask from the stress over its faces #
+    h = (grid_spacing(x), grid_spacing(y))
+    i, j, axis, sign = surface_faces(mask, free)
+    ni = i + sign * (axis == 0); nj = j + sign * (axis == 1)
+    spacing = np.where(axis == 0, h[0], h[1])
+    width = np.where(axis == 0, h[1], h[0])
+    E = (potential[ni, nj] - potential[i, j]) / spacing
+    pressure = 0.5 * eps_0 * E**2 * width * depth
+    return (np.sum(pressure * sign * (axis == 0)), np.sum(pressure * sign * (axis == 1)))
+
+def tip_force(d0, theta1, theta2, x_offset, nx=50, ny=50, V=V_0, depth=None):
+    '''
+    Attractive force (along +y, towards tip 2) and lateral force on tip 1
+    from a sparse potential solve. depth defaults to one grid cell, the
+    same depth as the A_ov pixel area of space_response.
+    '''
+    x, y, space, charge_space, surfaces =\
+       create_tip_space(d0, theta1, theta2, x_offset, nx, ny, compact=True)
+    if depth is None:
+        depth = grid_spacing(x)
+    potential = potential_solver(space, x, y)(conductor_potential(space, V / 2.0))
+    Fx, Fy = maxwell_force(potential, space > 0, space == 0, x, y, depth)
+    return Fy, Fx
+
+def force_gradient(d0, theta1, theta2, x_offset, nx=50, ny=50, V=V_0, depth=None,
+                   delta=None):
+    '''
+    Attractive force on tip 1 and its derivative with d0, from central
+    differences over d0 +/- delta/2. delta defaults to two grid cells, so
+    each tip moves by one whole cell.
+    '''
+    x, y = create_tip_grid(nx, ny)
+    if depth is None:
+        depth = grid_spacing(x)
+    if delta is None:
+        delta = 2 * grid_spacing(y)
+    F = [tip_force(d, theta1, theta2, x_offset, nx, ny, V, depth)[0]
+         for d in (d0 - delta/2, d0, d0 + delta/2)]
+    return F[1], (F[2] - F[0]) / delta
+
+def spring_response(x_offsets, d0=500e-9, theta1=np.radians(30), theta2=np.radians(15),
+                    nx=50, ny=50, V=V_0, k=None, omega=None, depth=None):
+    '''
+    Force, force gradient, effective spring constant k_e and the amplitude
+    and phase of the cantilever for every offset, each of shape
+    x_offsets.shape. k_e = k + dF/dd / 2 and the drive is F / 2, the same
+    factors as calculate_contribution, which this reproduces for parallel
+    plates.
+    '''
+    k = alignment_simulation.k_0 if k is None else k
+    omega = alignment_simulation.omega_p if omega is None else omega
+    m = alignment_simulation.m; beta = alignment_simulation.beta
+    x_offsets = np.asarray(x_offsets, dtype=np.float64)
+    F = np.empty(x_offsets.size); dF = np.empty(x_offsets.size)
+    for n, x_offset in enumerate(x_offsets.ravel()):
+        F[n], dF[n] = force_gradient(d0, theta1, theta2, x_offset, nx, ny, V, depth)
+    k_e = k + 0.5 * dF
+    amplitude = 0.5 * F / np.sqrt((k_e - m*omega**2)**2 + (beta * omega)**2)
+    phase = np.arctan((beta * omega) / (k_e - m * omega**2))
+    shape = x_offsets.shape
+    return {'force': F.reshape(shape), 'gradient': dF.reshape(shape),
+            'k_e': k_e.reshape(shape), 'amplitude': amplitude.reshape(shape),
+            'phase': phase.reshape(shape)}
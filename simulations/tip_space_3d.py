@@ -0,0 +1,152 @@
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from potential_simulation import V_0, grid_spacing, fixed_cells, conductor_potential
+from multigrid import mg_solver
+from alignment_simulation import calculate_contribution
+
+# 3d tip spaces #
+#
+# Tips are pyramids (or cones) with their apex on the y axis, the 3d
+# counterparts of the 2d triangles in conductor_creation: the z = 0 slice
+# through a pyramid is the 2d tip. Masks are stored bit-packed along z
+# (np.packbits), one byte per 8 cells, and only unpacked when needed.
+
+def create_tip_grid_3d(n=64):
+    # cubic grid used for all 3d tip spaces #
+    x = np.linspace(-5e-6, 5e-6, n)
+    y = np.linspace(-5e-6, 5e-6, n)
+    z = np.linspace(-5e-6, 5e-6, n)
+    return x, y, z
+
+def create_tip_levels_3d(d0, theta1, theta2, x_offset, shape='pyramid', z_offset=0.0):
+    '''
+    Level functions for the two tips, inside where the level is <= 0. For
+    a pyramid the faces towards -x and -z are at theta1 from the tip axis
+    on tip 1 (theta2 on tip 2) and the other faces at theta2 (theta1), as
+    in the 2d tips. A cone has half angle (theta1 + theta2)/2. Tip 1 is
+    moved by x_offset and z_offset across tip 2.
+    '''
+    def side(u, left, right):
+        # distance up the tip axis of a face at angle left (u<0) or right (u>=0) #
+        return np.where(u < 0, -u / np.tan(left), u / np.tan(right))
+    def spread(u, v, left, right):
+        if shape == 'pyramid':
+            return np.maximum(side(u, left, right), side(v, left, right))
+        elif shape == 'cone':
+            return np.hypot(u, v) / np.tan(0.5 * (theta1 + theta2))
+        raise ValueError("unknown tip shape %r" % shape)
+    def tip1_level(X, Y, Z):
+        return Y + d0/2 + spread(X - x_offset, Z - z_offset, theta1, theta2)
+    def tip2_level(X, Y, Z):
+        return d0/2 - Y + spread(X, Z, theta2, theta1)
+    return tip1_level, tip2_level
+
+def pack_mask(mask):
+    return np.packbits(mask, axis=-1)
+
+def unpack_mask(packed, nz):
+    return np.unpackbits(packed, axis=-1)[..., :nz].astype(bool)
+
+def rasterize_3d(level_func, x, y, z, slab=16):
+    '''
+    Bit-packed mask of the cells where level_func <= 0, evaluated in slabs
+    of `slab` x planes so only a slab of floats is ever held at once.
+    '''
+    packed = np.zeros((len(x), len(y), (len(z) + 7) // 8), dtype=np.uint8)
+    Y = y[np.newaxis, :, np.newaxis]; Z = z[np.newaxis, np.newaxis, :]
+    for i in range(0, len(x), slab):
+        X = x[i:i+slab, np.newaxis, np.newaxis]
+        packed[i:i+slab] = pack_mask(level_func(X, Y, Z) <= 0)
+    return packed
+
+def surface_mask_3d(mask):
+    # occupied cells with an empty cell in their 3x3x3 neighbourhood #
+    near_empty = ndimage.binary_dilation(~mask, structure=np.ones((3, 3, 3), dtype=bool))
+    return mask & near_empty
+
+def surface_areas(mask, index, level_func, x, y, z):
+    '''
+    Area of tip surface carried by each surface cell. The exposed faces of
+    a cell (those next to an empty cell) sum, over a flat surface with
+    unit normal n, to the true area times |nx|+|ny|+|nz|, so each cell's
+    exposed area is divided by that factor using the normal of the
+    analytic tip surface.
+    '''
+    h = [grid_spacing(x), grid_spacing(y), grid_spacing(z)]
+    face = [h[1]*h[2], h[0]*h[2], h[0]*h[1]]
+    exposed = np.zeros(len(index))
+    for axis in range(3):
+        for step in (-1, 1):
+            neighbour = index.copy()
+            neighbour[:, axis] += step
+            inside = (neighbour[:, axis] >= 0) & (neighbour[:, axis] < mask.shape[axis])
+            empty = np.zeros(len(index), dtype=bool)
+            n = neighbour[inside]
+            empty[inside] = ~mask[n[:, 0], n[:, 1], n[:, 2]]
+            exposed += empty * face[axis]
+    # normal from central differences of the level function #
+    p = np.column_stack((x[index[:, 0]], y[index[:, 1]], z[index[:, 2]]))
+    grad = np.zeros_like(p)
+    for axis in range(3):
+        e = np.zeros(3); e[axis] = 0.5 * h[axis]
+        grad[:, axis] = (level_func(*(p + e).T) - level_func(*(p - e).T)) / h[axis]
+    norm = np.sqrt((grad**2).sum(axis=1))
+    norm[norm == 0] = 1.0
+    return exposed / (np.abs(grad).sum(axis=1) / norm)
+
+def create_tip_space_3d(d0, theta1, theta2, x_offset, n=64, shape='pyramid', z_offset=0.0):
+    '''
+    3d version of create_tip_space. Returns x, y, z, the two bit-packed tip
+    masks, the compact surfaces [(index (m,3) int32, charge int8), ...] and
+    the surface area carried by each surface point.
+    '''
+    x, y, z = create_tip_grid_3d(n)
+    levels = create_tip_levels_3d(d0, theta1, theta2, x_offset, shape, z_offset)
+    masks = []; surfaces = []; areas = []
+    for level_func, q in zip(levels, (1, -1)):
+        packed = rasterize_3d(level_func, x, y, z)
+        mask = unpack_mask(packed, len(z))
+        index = np.argwhere(surface_mask_3d(mask)).astype(np.int32)
+        masks.append(packed)
+        surfaces.append((index, np.full(len(index), q, dtype=np.int8)))
+        areas.append(surface_areas(mask, index, level_func, x, y, z))
+    return x, y, z, masks, surfaces, areas
+
+def tip_space_array(masks, nz):
+    # dense int8 space with tip 1 as 1 and tip 2 as -1 #
+    return (unpack_mask(masks[0], nz).astype(np.int8) -
+            unpack_mask(masks[1], nz).astype(np.int8))
+
+def calculate_potential_3d(x, y, z, masks, V=V_0, **kwargs):
+    '''
+    Potential with tip 1 at +V, tip 2 at -V and the box edge grounded, from
+    a 3d multigrid solve. Extra keyword arguments go to the multigrid
+    solve; returns (potential, report).
+    '''
+    space = tip_space_array(masks, len(z))
+    # 3d direct solves fill in quickly, so keep the coarsest level small #
+    solve = mg_solver(fixed_cells(space), (grid_spacing(x), grid_spacing(y), grid_spacing(z)),
+                      coarsest=8)
+    return solve(conductor_potential(space, V), **kwargs)
+
+def get_nearest_separation_3d(surfaces, x, y, z, k=1):
+    # nearest tip 2 surface point to every tip 1 surface point, via a KD-tree #
+    p1, p2 = [np.column_stack((x[index[:, 0]], y[index[:, 1]], z[index[:, 2]]))
+              for index, charge in surfaces]
+    if len(p1) == 0 or len(p2) == 0:
+        return np.zeros((len(p1),) if k == 1 else (len(p1), k))
+    return cKDTree(p2).query(p1, k=k)[0]
+
+def alignment_response_3d(d0, theta1, theta2, x_offset, n=64, shape='pyramid',
+                          z_offset=0.0, V=None, k=None):
+    '''
+    Amplitude and phase for one 3d tip configuration: each tip 1 surface
+    point contributes through calculate_contribution with its own surface
+    area and its nearest separation from tip 2.
+    '''
+    x, y, z, masks, surfaces, areas =\
+       create_tip_space_3d(d0, theta1, theta2, x_offset, n, shape, z_offset)
+    d_0s = get_nearest_separation_3d(surfaces, x, y, z)
+    z_m1, phi_1 = calculate_contribution(d_0s, areas[0], V, k)
+    return z_m1.sum(), phi_1.sum()
@@ -0,0 +1,210 @@
+import time
+import numpy as np
+from conductor_creation import split_surface, surface_coordinates
+from potential_simulation import eps_0, direct_sum, conductor_interior
+
+# Barnes-Hut tree code for the Coulomb potential and field of surface charges #
+#
+# Sources are sorted into a quadtree. Each box holds its charge moments
+# about the box centre up to quadrupole order. A target uses a box's
+# expansion when box size < theta * distance, otherwise it opens the box
+# (or sums a leaf directly). Targets are walked down the tree together as
+# (target, box) pairs so every step is whole-array work.
+
+def build_tree(sources, charges, leaf_size=16, max_depth=32):
+    '''
+    Build a quadtree over source points (m,2) with charges (m,). Returns a
+    dict of node arrays: centre, half width, source range [start, end) in
+    the sorted order, children (-1 for none) and the charge moments.
+    '''
+    sources = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+    charges = np.asarray(charges, dtype=np.float64).ravel()
+    order = np.arange(sources.shape[0])
+    lo = sources.min(axis=0) if len(sources) else np.zeros(2)
+    hi = sources.max(axis=0) if len(sources) else np.zeros(2)
+    half = 0.5 * max(hi[0] - lo[0], hi[1] - lo[1]) * (1 + 1e-12) or 1.0
+    centre = [0.5 * (lo + hi)]; halves = [half]
+    start = [0]; end = [len(sources)]; children = [[-1, -1, -1, -1]]
+    stack = [(0, 0)]
+    while stack:
+        node, depth = stack.pop()
+        n0, n1 = start[node], end[node]
+        if n1 - n0 <= leaf_size or depth >= max_depth:
+            continue
+        c = centre[node]
+        idx = order[n0:n1]
+        quadrant = (2 * (sources[idx, 0] >= c[0]) + (sources[idx, 1] >= c[1]))
+        sort = np.argsort(quadrant, kind='mergesort')
+        order[n0:n1] = idx[sort]
+        counts = np.bincount(quadrant, minlength=4)
+        offset = n0
+        for q in range(4):
+            if counts[q] == 0:
+                offset += counts[q]
+                continue
+            h = 0.5 * halves[node]
+            sign = np.array([1.0 if q >= 2 else -1.0, 1.0 if q % 2 else -1.0])
+            children[node][q] = len(centre)
+            centre.append(c + h * sign); halves.append(h)
+            start.append(offset); end.append(offset + counts[q])
+            children.append([-1, -1, -1, -1])
+            stack.append((len(centre) - 1, depth + 1))
+            offset += counts[q]
+    tree = {'centre': np.array(centre).reshape(-1, 2), 'half': np.array(halves),
+            'start': np.array(start), 'end': np.array(end),
+            'children': np.array(children).reshape(-1, 4),
+            'sources': sources[order], 'charges': charges[order]}
+    tree.update(tree_moments(tree))
+    return tree
+
+def tree_moments(tree):
+    # monopole, dipole, second moment tensor and trace about each box centre #
+    n = len(tree['half'])
+    q = tree['charges']
+    s = tree['sources']
+    # cumulative sums let every box read its moments from its source range #
+    box = np.repeat(np.arange(n), tree['end'] - tree['start'])
+    member = np.concatenate([np.arange(a, b) for a, b in zip(tree['start'], tree['end'])]) \
+        if n else np.zeros(0, dtype=int)
+    d = s[member] - tree['centre'][box]
+    qm = q[member]
+    monopole = np.bincount(box, qm, minlength=n)
+    dipole = np.column_stack([np.bincount(box, qm * d[:, k], minlength=n) for k in range(2)])
+    second = np.zeros((n, 2, 2))
+    for a in range(2):
+        for b in range(2):
+            second[:, a, b] = np.bincount(box, qm * d[:, a] * d[:, b], minlength=n)
+    trace = second[:, 0, 0] + second[:, 1, 1]
+    return {'monopole': monopole, 'dipole': dipole, 'second': second, 'trace': trace}
+
+def _expansion(R, node, tree):
+    # potential and field of the box expansions at offsets R from the centres #
+    r2 = (R**2).sum(axis=1)
+    r = np.sqrt(r2)
+    M0 = tree['monopole'][node]
+    D = tree['dipole'][node]
+    T = tree['second'][node]
+    S = tree['trace'][node]
+    RD = (R * D).sum(axis=1)
+    TR = np.einsum('nij,nj->ni', T, R)
+    RTR = (R * TR).sum(axis=1)
+    r3 = r2 * r; r5 = r3 * r2; r7 = r5 * r2
+    V = M0/r + RD/r3 + (3*RTR - r2*S)/(2*r5)
+    E = (M0/r3)[:, np.newaxis] * R +\
+        (3*RD/r5)[:, np.newaxis] * R - D/r3[:, np.newaxis] -\
+        3*TR/r5[:, np.newaxis] + ((7.5*RTR/r7) - (1.5*S/r5))[:, np.newaxis] * R
+    return V, E
+
+def tree_sum(points, tree, theta=0.5, block=4096):
+    '''
+    Barnes-Hut potential, Ex, Ey and |E| at points (n,2) from a tree made by
+    build_tree. theta is the opening angle: smaller is more accurate and
+    slower, theta=0 reduces to the direct sum. Coincident pairs are left
+    out, as in the direct sum.
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n = points.shape[0]
+    result = np.zeros((3, n))
+    if n == 0 or len(tree['charges']) == 0:
+        return result[0], result[1], result[2], np.zeros(n)
+    is_leaf = (tree['children'] < 0).all(axis=1)
+    size = 2 * tree['half']
+    for b0 in range(0, n, block):
+        b1 = min(b0 + block, n)
+        target = np.arange(b0, b1)
+        node = np.zeros(b1 - b0, dtype=int)
+        while len(target):
+            R = points[target] - tree['centre'][node]
+            dist = np.sqrt((R**2).sum(axis=1))
+            accept = size[node] < theta * dist
+            if accept.any():
+                V, E = _expansion(R[accept], node[accept], tree)
+                t = target[accept]
+                result[0] += np.bincount(t, V, minlength=n)
+                result[1] += np.bincount(t, E[:, 0], minlength=n)
+                result[2] += np.bincount(t, E[:, 1], minlength=n)
+            leaf = ~accept & is_leaf[node]
+            if leaf.any():
+                # direct sum between each target and the sources of its leaf #
+                t = target[leaf]; l = node[leaf]
+                count = tree['end'][l] - tree['start'][l]
+                pair_t = np.repeat(t, count)
+                first = np.repeat(tree['start'][l] - np.cumsum(count) + count, count)
+                pair_s = first + np.arange(count.sum())
+                d = points[pair_t] - tree['sources'][pair_s]
+                r = np.sqrt((d**2).sum(axis=1))
+                r[r == 0] = np.inf
+                V = tree['charges'][pair_s] / r
+                result[0] += np.bincount(pair_t, V, minlength=n)
+                V /= r**2
+                result[1] += np.bincount(pair_t, V * d[:, 0], minlength=n)
+                result[2] += np.bincount(pair_t, V * d[:, 1], minlength=n)
+            # open the remaining boxes into their children #
+            opened = ~accept & ~is_leaf[node]
+            child = tree['children'][node[opened]]
+            has = child >= 0
+            target = np.repeat(target[opened], has.sum(axis=1))
+            node = child[has]
+    result /= 4*np.pi*eps_0
+    return result[0], result[1], result[2], np.hypot(result[1], result[2])
+
+def surface_tree(surfaces, x, y, leaf_size=16):
+    # tree over the charges of a list of legacy or compact surfaces #
+    sources = np.concatenate([surface_coordinates(surface, x, y) for surface in surfaces])
+    charges = np.concatenate([split_surface(surface)[1] for surface in surfaces])
+    return build_tree(sources, charges, leaf_size)
+
+def calculate_fields_tree(space, x, y, surfaces, theta=0.5, leaf_size=16):
+    '''
+    Tree code version of calculate_fields_direct: potential, Ex, Ey and |E|
+    grids from the charges in surfaces, skipping the conductor cells.
+    '''
+    tree = surface_tree(surfaces, x, y, leaf_size)
+    outside = ~conductor_interior(space)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    fields = tree_sum(np.column_stack((X[outside], Y[outside])), tree, theta)
+    grids = []
+    for values in fields:
+        grid = np.zeros(space.shape)
+        grid[outside] = values
+        grids.append(grid)
+    return tuple(grids)
+
+def tree_report(surfaces, x, y, points, thetas=(0.2, 0.4, 0.6, 0.8, 1.0), leaf_size=16):
+    '''
+    Error against speed of the tree code compared with direct_sum at the
+    given points. Returns one dict per theta with the tree and direct
+    times and the maximum potential and field errors relative to the
+    largest direct value.
+    '''
+    sources = np.concatenate([surface_coordinates(surface, x, y) for surface in surfaces])
+    charges = np.concatenate([split_surface(surface)[1] for surface in surfaces])
+    start = time.time()
+    V, Ex, Ey, E = direct_sum(points, sources, charges)
+    direct_time = time.time() - start
+    start = time.time()
+    tree = build_tree(sources, charges, leaf_size)
+    build_time = time.time() - start
+    report = []
+    for theta in thetas:
+        start = time.time()
+        Vt, Ext, Eyt, Et = tree_sum(points, tree, theta)
+        tree_time = time.time() - start
+        field_error = np.hypot(Ext - Ex, Eyt - Ey).max() / E.max()
+        report.append({'theta': theta, 'direct_time': direct_time,
+                       'build_time': build_time, 'tree_time': tree_time,
+                       'potential_error': abs(Vt - V).max() / abs(V).max(),
+                       'field_error': field_error})
+    return report
+
+if __name__ == '__main__':
+    from conductor_creation import create_tip_space
+    x, y, space, charge_space, surfaces =\
+       create_tip_space(500e-9, np.radians(30), np.radians(15), 0.0, 2000, 2000, compact=True)
+    rng = np.random.RandomState(0)
+    points = np.column_stack((rng.uniform(x.min(), x.max(), 20000),
+                              rng.uniform(y.min(), y.max(), 20000)))
+    print("theta  direct(s)  tree(s)  V error   E error")
+    for row in tree_report(surfaces, x, y, points):
+        print("%5.2f  %9.3f  %7.3f  %.2e  %.2e" % (row['theta'], row['direct_time'],
+              row['tree_time'], row['potential_error'], row['field_error']))